@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
+sys.path.append(libdir)
+
+import rawparse
+import rawid
+
+# synthetic raws
+
+def _writegen(rawdir, name, objt, objects):
+    text = name + '\n\n[OBJECT:' + objt + ']\n' + ''.join(objects)
+    with open(os.path.join(rawdir, name + '.txt'), 'wb') as f:
+        f.write(rawparse.crlf(text.encode(rawparse.df_raw_encoding)))
+
+def _genobj(token, tags):
+    return '\n[' + token + ']\n' + ''.join('\t[' + ':'.join(t) + ']\n' for t in tags)
+
+def gen_raws(rawdir, files = 10, objects = 100, tags = 20, seed = 0):
+    rnd = random.Random(seed)
+    if not os.path.isdir(rawdir):
+        os.makedirs(rawdir)
+
+    templates = ['MT_{:d}'.format(i) for i in range(max(1, objects // 10))]
+    _writegen(rawdir, 'material_template_gen', 'MATERIAL_TEMPLATE', [
+        _genobj('MATERIAL_TEMPLATE:' + mt,
+                [('STATE_NAME_ADJ', 'ALL_SOLID', mt.lower()),
+                 ('SOLID_DENSITY', str(rnd.randint(500, 20000))),
+                 ('SHEAR_YIELD', str(rnd.randint(1000, 100000))),
+                 ('SHEAR_FRACTURE', str(rnd.randint(1000, 100000)))])
+        for mt in templates])
+    _writegen(rawdir, 'body_gen', 'BODY', [
+        _genobj('BODY:' + body, [('BP', 'UB', 'upper body', 'upper bodies')])
+        for body in ('QUADRUPED', 'HUMANOID')])
+    _writegen(rawdir, 'c_variation_gen', 'CREATURE_VARIATION', [
+        _genobj('CREATURE_VARIATION:GIANT',
+                [('CV_ADD_TAG', 'GIANT'), ('CV_REMOVE_TAG', 'SMALL')]),
+        _genobj('CREATURE_VARIATION:ANIMAL_PERSON',
+                [('CV_ADD_TAG', 'INTELLIGENT'), ('CV_CONVERT_TAG',),
+                 ('CVCT_MASTER', 'BODY'), ('CVCT_TARGET', 'QUADRUPED'),
+                 ('CVCT_REPLACEMENT', 'HUMANOID')])])
+
+    for i in range(files):
+        if i % 4 == 3:
+            name, objt, subtype = 'inorganic_gen{:d}'.format(i), 'INORGANIC', 'INORGANIC'
+        else:
+            name, objt, subtype = 'creature_gen{:d}'.format(i), 'CREATURE', 'CREATURE'
+        objs = []
+        for j in range(objects):
+            ident = '{:s}_{:d}_{:d}'.format(subtype, i, j)
+            body = [('USE_MATERIAL_TEMPLATE', rnd.choice(templates))]
+            body += [('GEN_{:d}'.format(rnd.randint(0, 4 * tags)),
+                      str(rnd.randint(0, 1000)), 'ARG_{:d}'.format(rnd.randint(0, 100)))
+                     for _ in range(tags)]
+            if subtype == 'CREATURE':
+                body += [('BODY', 'QUADRUPED'),
+                         ('BODY_SIZE', '0', '0', str(rnd.randint(1, 1000000))),
+                         ('MAX_AGE', str(rnd.randint(1, 50)), str(rnd.randint(50, 100)))]
+                objs.append(_genobj('CREATURE:' + ident, body))
+                if j % 10 == 0:
+                    for cv in ('GIANT', 'ANIMAL_PERSON'):
+                        objs.append(_genobj('CREATURE:' + ident + '_' + cv,
+                                            [('COPY_TAGS_FROM', ident),
+                                             ('APPLY_CREATURE_VARIATION', cv),
+                                             ('GO_TO_END',),
+                                             ('NAME', cv.lower())]))
+            else:
+                body += [('SOLID_DENSITY', str(rnd.randint(500, 20000))),
+                         ('IMPACT_YIELD', str(rnd.randint(1000, 100000))),
+                         ('IMPACT_FRACTURE', str(rnd.randint(1000, 100000)))]
+                objs.append(_genobj('INORGANIC:' + ident, body))
+        _writegen(rawdir, name, objt, objs)
+
+# measurement
+
+def measure(fn, repeat = 1, memory = True):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {'seconds' : min(times)}
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['peak_bytes'] = peak
+    return result
+
+def _throughput(result, nbytes = None, nobjects = None):
+    seconds = max(result['seconds'], 1e-9)
+    if nbytes is not None:
+        result['bytes'] = nbytes
+        result['mb_per_s'] = nbytes / seconds / 1e6
+    if nobjects is not None:
+        result['objects'] = nobjects
+        result['objects_per_s'] = nobjects / seconds
+    return result
+
+def run(rawdir, repeat = 1, memory = True, workers = None, queries = ()):
+    fpaths = rawid.raw_fpaths(rawdir)
+    bufs = []
+    for fpath in fpaths:
+        with open(fpath, 'rb') as f:
+            bufs.append(f.read())
+    nbytes = sum(map(len, bufs))
+    ridx = rawid.Rindex(rawroot=rawdir, verbosity=-1, strict=False)
+    nobjects = len(ridx.objects)
+
+    results = {}
+    def bench(name, fn, **kwargs):
+        results[name] = _throughput(measure(fn, repeat=repeat, memory=memory), **kwargs)
+
+    for engine in rawparse.engines:
+        bench('parse.' + engine,
+              lambda: [rawparse.parse(buf, engine=engine) for buf in bufs],
+              nbytes=nbytes)
+        bench('fparse.' + engine,
+              lambda: [rawparse.fparse(fpath, engine=engine) for fpath in fpaths],
+              nbytes=nbytes)
+        bench('readraw.' + engine,
+              lambda: [rawparse.readraw(fpath, verbosity=-1, engine=engine) for fpath in fpaths],
+              nbytes=nbytes)
+        bench('index.' + engine,
+              lambda: rawid.Rindex(rawroot=rawdir, verbosity=-1, strict=False, engine=engine),
+              nbytes=nbytes, nobjects=nobjects)
+    if workers is not None:
+        bench('index.workers',
+              lambda: rawid.Rindex(rawroot=rawdir, verbosity=-1, strict=False, workers=workers),
+              nbytes=nbytes, nobjects=nobjects)
+
+    parsed = [rawparse.parse(buf) for buf in bufs]
+    readtups = [rawparse.readraw(fpath, verbosity=-1) for fpath in fpaths]
+    bench('unparse', lambda: [rawparse.unparse(tup) for tup in parsed], nbytes=nbytes)
+    bench('encoderaw', lambda: [rawparse.encoderaw(tup) for tup in readtups], nbytes=nbytes)
+
+    def query():
+        ridx.reindex_tags()
+        for tag in queries:
+            ridx.find_tag(tag)
+            ridx.find_tag(tag, search_args=True)
+            ridx.find_arg(tag)
+    bench('query', query, nobjects=nobjects)
+
+    outdir = tempfile.mkdtemp()
+    try:
+        def todir():
+            shutil.rmtree(outdir)
+            ridx.todir(outdir)
+        bench('todir', todir, nbytes=nbytes, nobjects=nobjects)
+        bench('todir.update', lambda: ridx.todir(outdir, update=True),
+              nbytes=nbytes, nobjects=nobjects)
+        if workers is not None:
+            def todir_workers():
+                shutil.rmtree(outdir)
+                ridx.todir(outdir, workers=workers)
+            bench('todir.workers', todir_workers, nbytes=nbytes, nobjects=nobjects)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+    return {
+        'rawdir' : rawdir,
+        'files' : len(fpaths),
+        'bytes' : nbytes,
+        'objects' : nobjects,
+        'repeat' : repeat,
+        'results' : results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark raw parsing, indexing and writing')
+    parser.add_argument('--rawdir', help='benchmark an existing raw directory instead of synthetic raws')
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--objects', type=int, default=100, help='objects per file')
+    parser.add_argument('--tags', type=int, default=20, help='tags per object')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc peak measurement')
+    parser.add_argument('--query', action='append', default=[],
+                        help='tag to query (default BODY_SIZE, GEN_0, QUADRUPED)')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.rawdir is None:
+        tmpdir = tempfile.mkdtemp()
+        rawdir = os.path.join(tmpdir, 'objects')
+        gen_raws(rawdir, files=args.files, objects=args.objects, tags=args.tags, seed=args.seed)
+    else:
+        rawdir = args.rawdir
+
+    try:
+        report = run(rawdir, repeat=args.repeat, memory=not args.no_memory,
+                     workers=args.workers,
+                     queries=args.query or ['BODY_SIZE', 'GEN_0', 'QUADRUPED'])
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'wt') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -15,22 +15,9 @@ ridx = rawid.Rindex(rawroot=rawdir, verbosity=0, strict=True)
 # useful things
 
 def find_tag(tag, search_args=False, p=True, r=False):
-    if r:
-        results = []
-    for ns in ridx.namespaces:
-        for ro in ns:
-            if search_args:
-                if any(tag in tags for tags in ro):
-                    if p:
-                        print(ns.name, ro.ident)
-                    if r:
-                        results.append(ro)
-            else:
-                if tag in ro:
-                    if p:
-                        print(ns.name, ro.ident)
-                    if r:
-                        results.append(ro)
+    results = ridx.find_tag(tag, search_args=search_args)
+    if p:
+        print_ros(results)
     if r:
         return results
 
@@ -38,15 +25,8 @@ def get_tag(tag, search_args=False):
     return find_tag(tag, search_args=search_args, p=False, r=True)
 
 def filter_tag(ros, tag, search_args=False):
-    new_ros = []
-    for ro in ros:
-        if search_args:
-            if any(tag in tags for tags in ro):
-                new_ros.append(ro)
-        else:
-            if tag in ro:
-                new_ros.append(ro)
-    return new_ros
+    hits = set(map(id, ridx.find_tag(tag, search_args=search_args)))
+    return [ro for ro in ros if id(ro) in hits]
 
 def print_ros(ros):
     for ro in ros:
@@ -76,24 +56,15 @@ def fix_spaces_in_ids(ridx):
     for ro in ridx.objects:
         if nonident_re.search(ro.ident):
             xlat[ro.ident] = fix_ident(ro.ident)
-        for tags in ro:
-            if nonident_re.search(tags[0]):
-                xlat[tags[0]] = fix_ident(tags[0])
+        for tokname in ro.toknames():
+            if nonident_re.search(tokname):
+                xlat[tokname] = fix_ident(tokname)
 
     # for k in xlat:
     #     print('{:30s} -> {:30s}'.format(k, xlat[k]))
     
     print('mapping has {:d} entries'.format(len(xlat)))
 
-    replacements = 0
-    for ro in ridx.objects:
-        if ro.ident in xlat:
-            ro.ident = xlat[ro.ident]
-            replacements += 1
-        for tags in ro:
-            for i in range(len(tags)):
-                if tags[i] in xlat:
-                    tags[i] = xlat[tags[i]]
-                    replacements += 1
-
-    print('replaced {:d} tags'.format(replacements))
+    hits = ridx.rewrite([(None, None, k, xlat[k]) for k in xlat])
+
+    print('replaced {:d} tags'.format(sum(hits)))
@@ -0,0 +1,120 @@
+import os
+
+# diagnostic code -> (severity, message template)
+# INVALID problems raise ValueError in strict mode, WARNINGs never do.
+df_diag_codes = {
+    # raw file headers
+    'raw-extension' : ('WARNING', 'raw file {!r} does not appear to have .txt extension'),
+    'raw-name-whitespace' : ('WARNING', 'whitespace in raw filename {!r}'),
+    'raw-name-mismatch' : ('WARNING', 'raw name {!r} does not agree with filename {!r}'),
+    'raw-header-invalid' : ('WARNING', 'name or object token {!r} is invalid!'),
+    'object-no-type' : ('WARNING', 'object token {!r} does not have type'),
+    'object-many-args' : ('WARNING', 'object token {!r} has more than one argument'),
+    # namespaces and objects
+    'namespace-prefix' : ('INVALID', 'namespace {!r} does not start with type {!r}'),
+    'object-type' : ('INVALID', 'unrecognized raw object type {!r}'),
+    'no-ident' : ('INVALID', 'no identifier in token {!r}'),
+    'multiple-idents' : ('INVALID', 'multiple identifiers in token {!r}'),
+    'duplicate-ident' : ('INVALID', 'duplicate ident {!r}'),
+    'unknown-subtype' : ('INVALID', 'unrecognized subtype {!r} for ident {!r}'),
+    # the index as a whole
+    'duplicate-namespace' : ('INVALID', 'duplicate namespace {!r}, ignoring'),
+    'duplicate-subtype-ident' : ('INVALID', 'duplicate ident {!r} for subtype {!r}, ignoring'),
+    'duplicate-rawtype-ident' : ('INVALID', 'duplicate ident {!r} for rawtype {!r}, ignoring'),
+    'variation-parent' : ('INVALID', 'creature variation {!r} has invalid parent'),
+}
+
+# codes produced while building the index, rather than while parsing one file
+df_index_codes = frozenset(('duplicate-namespace', 'duplicate-subtype-ident',
+                            'duplicate-rawtype-ident', 'variation-parent'))
+
+# Collects problems as (code, fpath, offset, ident, args) records. Messages
+# are only formatted when something is echoed, raised or reported, so a
+# quiet collector (verbosity < 0) costs one tuple per problem. offset is
+# the byte offset of the offending object in its file, where known.
+#
+# With collect=True nothing is raised, even for a strict index, so one
+# build finds every problem; check() raises afterwards if any were INVALID.
+class Rdiag(object):
+    def __init__(self, verbosity = 0, strict = True, collect = False):
+        self.verbosity = verbosity
+        self.strict = strict
+        self.collect = collect
+        self.records = []
+
+    # an empty collector with the same settings, for worker processes
+    def fresh(self):
+        return Rdiag(verbosity=self.verbosity, strict=self.strict, collect=self.collect)
+
+    def add(self, code, fpath = None, offset = None, ident = None, *args):
+        record = (code, fpath, offset, ident, args)
+        self.records.append(record)
+        severity = df_diag_codes[code][0]
+        if self.verbosity >= 0:
+            print('{:s}: {:s}'.format(severity, self.message(record, where=True)))
+        if severity == 'INVALID' and self.strict and not self.collect:
+            raise ValueError(self.message(record))
+
+    def message(self, record, where = False):
+        code, fpath, offset, _, args = record
+        msg = df_diag_codes[code][1].format(*args)
+        if where and fpath is not None:
+            if offset is None:
+                msg += ' ({:s})'.format(os.path.basename(fpath))
+            else:
+                msg += ' ({:s}, byte {:d})'.format(os.path.basename(fpath), offset)
+        return msg
+
+    def merge(self, other):
+        self.records.extend(other.records)
+
+    # forget records that are about to be regenerated
+    def discard(self, fpaths = None, codes = None):
+        self.records = [r for r in self.records
+                        if not ((fpaths is None or r[1] in fpaths)
+                                and (codes is None or r[0] in codes))]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def errors(self):
+        return [r for r in self.records if df_diag_codes[r[0]][0] == 'INVALID']
+
+    def warnings(self):
+        return [r for r in self.records if df_diag_codes[r[0]][0] == 'WARNING']
+
+    def summary(self):
+        counts = {}
+        for r in self.records:
+            counts[r[0]] = counts.get(r[0], 0) + 1
+        return counts
+
+    def by_file(self):
+        files = {}
+        for r in self.records:
+            if r[1] in files:
+                files[r[1]].append(r)
+            else:
+                files[r[1]] = [r]
+        return files
+
+    def check(self):
+        errors = self.errors()
+        if errors:
+            raise ValueError('{:d} invalid raw problems, first: {:s}'
+                             .format(len(errors), self.message(errors[0], where=True)))
+
+    def report(self, n = 10):
+        lines = ['{:d} problems, {:d} invalid'.format(len(self.records), len(self.errors()))]
+        for code, count in sorted(self.summary().items(), key=lambda x: (-x[1], x[0])):
+            lines.append('  {:8s} {:24s} {:8d}'.format(df_diag_codes[code][0], code, count))
+        for fpath, records in sorted(self.by_file().items(), key=lambda x: -len(x[1]))[:n]:
+            lines.append('{:s}: {:d} problems'
+                         .format('(index)' if fpath is None else os.path.basename(fpath),
+                                 len(records)))
+            for r in records[:n]:
+                lines.append('  {:s}: {:s}'.format(df_diag_codes[r[0]][0], self.message(r)))
+        return '\n'.join(lines)
@@ -0,0 +1,134 @@
+# differences between two raw indices
+
+import sys
+import json
+import difflib
+import hashlib
+
+import rawid
+
+# Objects are paired by (subtype, ident), so moving an object to another
+# file or reordering a file is not a change. Only tokens are compared;
+# comments and whitespace are ignored. Records are plain dicts:
+#
+#   {"op": "namespace-added" / "namespace-removed", "namespace": ...}
+#   {"op": "added" / "removed", "subtype": ..., "ident": ..., "namespace": ...}
+#   {"op": "changed", "subtype": ..., "ident": ..., "namespace": ...,
+#    "old_namespace": ... (only if it moved), "tokens": [edit, ...]}
+#   {"op": "moved", ...}  (tokens unchanged, but in another namespace)
+#
+# and each edit is {"op": "insert" / "delete" / "replace", "old": [i, j],
+# "new": [k, l], "old_tokens": [...], "new_tokens": [...]}, giving token
+# index ranges into the old and new object.
+
+def _tokens(robj):
+    fields = robj._fields
+    offsets = robj._offsets
+    return [tuple(fields[offsets[i]:offsets[i+1]]) for i in range(robj._ntokens())]
+
+# Fields cannot contain ':', so joining them with it is unambiguous once
+# the offsets are hashed too. The digest is kept on the object until it
+# is edited, so comparing the same index again is one lookup per object.
+def _digest(robj):
+    cached = robj._digest
+    if cached is not None and cached[0] == robj._version:
+        return cached[1]
+    h = hashlib.blake2b(':'.join(robj._fields).encode('utf-8', 'surrogatepass'), digest_size=16)
+    h.update(robj._offsets.tobytes())
+    digest = h.digest()
+    robj._digest = robj._version, digest
+    return digest
+
+def _same(a, b):
+    # shared bodies (an overlay's layers, or an Rpool with dedup) are equal
+    if a is b or a._fields is b._fields:
+        return True
+    return _digest(a) == _digest(b)
+
+def _objects(ridx):
+    # every object once, under its own subtype: rawtype keys like ITEM alias them
+    for subtype in sorted(ridx._robj_master):
+        for ident, robj in sorted(ridx._robj_master[subtype].items()):
+            if robj.subtype == subtype:
+                yield (subtype, ident), robj
+
+def token_diff(a, b):
+    old = _tokens(a)
+    new = _tokens(b)
+    edits = []
+    for op, i, j, k, l in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if op == 'equal':
+            continue
+        edits.append({'op' : op, 'old' : [i, j], 'new' : [k, l],
+                      'old_tokens' : [list(t) for t in old[i:j]],
+                      'new_tokens' : [list(t) for t in new[k:l]]})
+    return edits
+
+def iterdiff(old, new):
+    old._load()
+    new._load()
+
+    old_names = {rns.name for rns in old.namespaces}
+    new_names = {rns.name for rns in new.namespaces}
+    for name in sorted(old_names - new_names):
+        yield {'op' : 'namespace-removed', 'namespace' : name}
+    for name in sorted(new_names - old_names):
+        yield {'op' : 'namespace-added', 'namespace' : name}
+
+    new_objects = dict(_objects(new))
+    for k, a in _objects(old):
+        subtype, ident = k
+        b = new_objects.pop(k, None)
+        if b is None:
+            yield {'op' : 'removed', 'subtype' : subtype, 'ident' : ident,
+                   'namespace' : a.namespace.name}
+            continue
+        moved = a.namespace.name != b.namespace.name
+        if _same(a, b):
+            if moved:
+                yield {'op' : 'moved', 'subtype' : subtype, 'ident' : ident,
+                       'namespace' : b.namespace.name, 'old_namespace' : a.namespace.name}
+            continue
+        record = {'op' : 'changed', 'subtype' : subtype, 'ident' : ident,
+                  'namespace' : b.namespace.name}
+        if moved:
+            record['old_namespace'] = a.namespace.name
+        record['tokens'] = token_diff(a, b)
+        yield record
+    for (subtype, ident), b in sorted(new_objects.items()):
+        yield {'op' : 'added', 'subtype' : subtype, 'ident' : ident,
+               'namespace' : b.namespace.name}
+
+def diff(old, new):
+    return list(iterdiff(old, new))
+
+# one JSON record per line; returns {op : count}
+def writediff(old, new, f = sys.stdout):
+    counts = {}
+    for record in iterdiff(old, new):
+        f.write(json.dumps(record))
+        f.write('\n')
+        counts[record['op']] = counts.get(record['op'], 0) + 1
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='compare two directories of raws')
+    parser.add_argument('old', metavar='OLDDIR')
+    parser.add_argument('new', metavar='NEWDIR')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--summary', action='store_true',
+                        help='print only the number of records of each kind')
+    args = parser.parse_args()
+
+    old = rawid.Rindex(rawroot=args.old, verbosity=-1, strict=False, workers=args.workers)
+    new = rawid.Rindex(rawroot=args.new, verbosity=-1, strict=False, workers=args.workers)
+    if args.summary:
+        counts = {}
+        for record in iterdiff(old, new):
+            counts[record['op']] = counts.get(record['op'], 0) + 1
+        for op, count in sorted(counts.items()):
+            print('{:20s} {:d}'.format(op, count))
+    else:
+        writediff(old, new)
@@ -1,25 +1,32 @@
 # dwarf fortress raw indexer
 
 import os
-import traceback
+import sys
+import array
+import mmap
+import time
+import pickle
+import hashlib
+import bisect
+import itertools
+import concurrent.futures
 
 # It turns out saving / loading the index object as YAML is 10x slower
-# than just parsing all the files...
-
-# def _importyaml():
-#     from yaml import load, dump
-#     try:
-#         from yaml import CLoader as Loader, CDumper as Dumper
-#     except ImportError:
-#         from yaml import Loader, Dumper
-#     def yload(stream):
-#         return load(stream, Loader=Loader)
-#     def ydump(data, stream):
-#         return dump(data, stream, Dumper=Dumper)
-#     return yload, ydump
-# yload, ydump = _importyaml()
+# than just parsing all the files, so snapshots are pickled instead, and
+# each raw file is revalidated by (mtime, size) or content hash on load.
+
+snapshot_version = 13
 
 import rawparse
+import rawstats
+import rawdiag
+import rawquery
+
+# numpy is optional, columns fall back to the array module without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 df_raw_types = {
     'BODY' : {'BODY'},
@@ -78,143 +85,447 @@ df_raw_ns_names = {
     'TISSUE_TEMPLATE' : 'tissue_template',
 }
 
+# tokens that refer to other objects:
+# token name -> ((argument position, target subtype), ...)
+# position None means every argument, -1 means the last one
+df_raw_refs = {
+    'COPY_TAGS_FROM' : ((1, 'CREATURE'),),
+    'APPLY_CREATURE_VARIATION' : ((1, 'CREATURE_VARIATION'),),
+    'BODY' : ((None, 'BODY'),),
+    'BODY_DETAIL_PLAN' : ((1, 'BODY_DETAIL_PLAN'),),
+    'USE_MATERIAL_TEMPLATE' : ((-1, 'MATERIAL_TEMPLATE'),),
+    'USE_TISSUE_TEMPLATE' : ((-1, 'TISSUE_TEMPLATE'),),
+    'CAN_DO_INTERACTION' : ((1, 'INTERACTION'),),
+    'CREATURE' : ((1, 'CREATURE'),),
+    'TRANSLATION' : ((1, 'TRANSLATION'),),
+    'PERMITTED_REACTION' : ((1, 'REACTION'),),
+    'PERMITTED_BUILDING' : ((1, 'BUILDING_WORKSHOP'),),
+    'AMMO' : ((1, 'ITEM_AMMO'),),
+    'ARMOR' : ((1, 'ITEM_ARMOR'),),
+    'DIGGER' : ((1, 'ITEM_WEAPON'),),
+    'GLOVES' : ((1, 'ITEM_GLOVES'),),
+    'HELM' : ((1, 'ITEM_HELM'),),
+    'INSTRUMENT' : ((1, 'ITEM_INSTRUMENT'),),
+    'PANTS' : ((1, 'ITEM_PANTS'),),
+    'SHIELD' : ((1, 'ITEM_SHIELD'),),
+    'SHOES' : ((1, 'ITEM_SHOES'),),
+    'SIEGEAMMO' : ((1, 'ITEM_SIEGEAMMO'),),
+    'TOOL' : ((1, 'ITEM_TOOL'),),
+    'TOY' : ((1, 'ITEM_TOY'),),
+    'TRAPCOMP' : ((1, 'ITEM_TRAPCOMP'),),
+    'WEAPON' : ((1, 'ITEM_WEAPON'),),
+}
+
+# Bumped by every direct edit to any object, so an index can cheaply tell
+# when what it derived from its objects might be stale, see Rindex._check_edits
+_edits = 0
+
+def _edited():
+    global _edits
+    _edits += 1
+
+# Token data for an object is stored flat: every field of every token
+# (name first) goes in one list, and token i is fields[offsets[i]:offsets[i+1]].
+# Indexing an object returns an Rtoken view into that storage.
+
+class Rtoken(object):
+    __slots__ = ('_robj', '_i')
+
+    def __init__(self, robj, i):
+        self._robj = robj
+        self._i = i
+
+    def _span(self):
+        offsets = self._robj._offsets
+        return offsets[self._i], offsets[self._i+1]
+
+    def __len__(self):
+        start, end = self._span()
+        return end - start
+
+    def __getitem__(self, j):
+        start, end = self._span()
+        if isinstance(j, slice):
+            return self._robj._fields[start:end][j]
+        if j < 0:
+            j += end - start
+        if j < 0 or j >= end - start:
+            raise IndexError('token field index out of range')
+        return self._robj._fields[start+j]
+
+    def __setitem__(self, j, v):
+        n = len(self)
+        if j < 0:
+            j += n
+        if j < 0 or j >= n:
+            raise IndexError('token field index out of range')
+        self._robj._set_field(self._i, j, v)
+
+    def __iter__(self):
+        start, end = self._span()
+        return iter(self._robj._fields[start:end])
+
+    def __contains__(self, v):
+        start, end = self._span()
+        fields = self._robj._fields
+        return any(fields[j] == v for j in range(start, end))
+
+    def __eq__(self, other):
+        if isinstance(other, (Rtoken, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+# Shared pool for the strings of many objects. Raws repeat the same
+# arguments and whitespace comments endlessly, and the parser decodes each
+# occurrence into its own str, so objects built with a pool keep one copy
+# of each. With dedup, objects whose bodies (everything after the header
+# token) are identical, such as a creature copied unchanged into a mod,
+# also share one set of body lists; an edit copies them first.
+#
+# The pool only grows as files are read, so an index that owns its pool
+# prunes it once it has doubled since the last prune, dropping strings of
+# file versions that refresh has since replaced. A pool shared between
+# indices is never pruned by them; recreate it, or call prune with every
+# live object, to reclaim that memory.
+class Rpool(object):
+    def __init__(self, dedup = False):
+        self.strs = {}
+        # body hash -> [(fields, offsets, comments, tagd)]
+        self.blocks = {} if dedup else None
+        # len(strs) after the last prune
+        self.pruned = 0
+
+    # Start over from the strings and bodies of objects, re-interning them
+    # so equal strings are shared again. Views keep their bodies undecoded.
+    def prune(self, objects):
+        self.strs = {}
+        intern = self.strs.setdefault
+        if self.blocks is not None:
+            self.blocks = {}
+        seen = set()
+        for robj in objects:
+            robj._comment = intern(robj._comment, robj._comment)
+            robj._ident = intern(robj._ident, robj._ident)
+            if robj._view or id(robj._fields) in seen:
+                continue
+            seen.add(id(robj._fields))
+            robj._comments[:] = map(intern, robj._comments, robj._comments)
+            robj._fields[:] = map(intern, robj._fields, robj._fields)
+            if self.blocks is not None:
+                self._dedup(robj)
+        self.pruned = len(self.strs)
+
+    def _dedup(self, robj):
+        k = hash((tuple(robj._fields), tuple(robj._comments)))
+        body = robj._fields, robj._offsets, robj._comments, robj._tagd
+        if k not in self.blocks:
+            self.blocks[k] = [body]
+            return
+        for other in self.blocks[k]:
+            fields, offsets, comments, tagd = other
+            if fields == robj._fields and comments == robj._comments and offsets == robj._offsets:
+                robj._fields, robj._offsets, robj._comments, robj._tagd = other
+                robj._shared = True
+                return
+        self.blocks[k].append(body)
+
+    # re-intern an object built elsewhere, such as in a worker process
+    def adopt(self, robj):
+        intern = self.strs.setdefault
+        robj._comment = intern(robj._comment, robj._comment)
+        robj._ident = intern(robj._ident, robj._ident)
+        if robj._shared:
+            robj._unshare()
+        robj._comments[:] = map(intern, robj._comments, robj._comments)
+        robj._fields[:] = map(intern, robj._fields, robj._fields)
+        if self.blocks is not None:
+            self._dedup(robj)
+
 class Robject(object):
-    def __init__(self, content, ns = None, verbosity = 0, strict = True):
+    __slots__ = ('namespace', '_comment', '_token', 'subtype', '_ident',
+                 '_comments', '_fields', '_offsets', '_tagd', '_version',
+                 '_start', '_end', '_dirty', '_shared', '_view', '_digest')
+
+    # diag is a rawdiag.Rdiag; span is the (start, end) byte range of the
+    # content in the file at fpath, if it was read from one. Strings go
+    # through pool, an Rpool, if there is one.
+    # With view, content is just the header context, and the rest of the
+    # object is decoded from ns._mm at span on first use; see Rnamespace.
+    def __init__(self, content, ns = None, verbosity = 0, strict = True,
+                 diag = None, fpath = None, span = None, pool = None, view = False):
+        if diag is None:
+            diag = rawdiag.Rdiag(verbosity=verbosity, strict=strict)
         self.namespace = ns
+        if span is None:
+            self._start = self._end = offset = None
+        else:
+            self._start, self._end = span
+            offset = self._start
+        intern = None if pool is None else pool.strs.setdefault
         comment, token, tokname, tags = content[0]
-        self._comment = comment
+        self._comment = comment if intern is None else intern(comment, comment)
         self._token = token
-        self.subtype = tokname
+        self.subtype = sys.intern(tokname)
         if len(tags) < 1:
-            self.ident = ''
-            if verbosity >= 0:
-                print('INVALID: no identifier in token {:s}'
-                      .format(repr(token)))
-            if strict:
-                raise ValueError('no ident in token {:s}'
-                                 .format(repr(token)))
+            self._ident = ''
+            diag.add('no-ident', fpath, offset, None, token)
         else:
-            self.ident = tags[0]
+            self._ident = tags[0] if intern is None else intern(tags[0], tags[0])
             if len(tags) > 1:
-                if verbosity >= 0:
-                    print('INVALID: multiple identifiers in token {:s}'
-                          .format(repr(token)))
-                if strict:
-                    raise ValueError('multiple idents in token {:s}'
-                                     .format(repr(token)))
+                diag.add('multiple-idents', fpath, offset, self.ident, token)
 
+        # bumped on every edit, so cached results can tell they are stale
+        self._version = 0
+        # edited since it was read or last written back to its file
+        self._dirty = False
+        # body lists shared with identical objects, see Rpool
+        self._shared = False
+        # body not decoded yet, so _comments, _fields, _offsets and _tagd are unset
+        self._view = view
+        # (version, digest) of the tokens, cached by rawdiff
+        self._digest = None
+        if not view:
+            self._init_body(content[1:], pool)
+
+    def _init_body(self, contexts, pool):
+        intern = None if pool is None else pool.strs.setdefault
         self._comments = []
-        self._tokens = []
-        self._tags = []
+        self._fields = []
+        self._offsets = array.array('I', (0,))
         self._tagd = {}
         i = 0
-        for comment, token, tokname, tags in content[1:]:
-            self._comments.append(comment)
+        for comment, token, tokname, tags in contexts:
+            self._comments.append(comment if intern is None else intern(comment, comment))
             if token:
-                self._tokens.append(token)
-                self._tags.append([tokname if j < 1 else tags[j-1]
-                                  for j in range(len(tags)+1)])
+                tokname = sys.intern(tokname)
+                self._fields.append(tokname)
+                self._fields.extend(tags if intern is None else map(intern, tags, tags))
+                self._offsets.append(len(self._fields))
                 if tokname in self._tagd:
                     self._tagd[tokname].append(i)
                 else:
                     self._tagd[tokname] = [i]
             i += 1
+        if pool is not None and pool.blocks is not None:
+            pool._dedup(self)
+
+    def _materialize(self):
+        ns = self.namespace
+        start = self._start + len(self._comment) + len(self._token)
+        self._init_body(rawparse.iterspan(ns._mm, start, self._end), ns._pool)
+        self._view = False
+
+    def __getattr__(self, name):
+        if name in ('_comments', '_fields', '_offsets', '_tagd') and self._view:
+            self._materialize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    # the mapping does not travel, so views are decoded before pickling
+    def __getstate__(self):
+        if self._view:
+            self._materialize()
+        return None, {k : getattr(self, k) for k in self.__slots__}
+
+    # the header is part of the object, so renaming it counts as an edit
+    @property
+    def ident(self):
+        return self._ident
+
+    @ident.setter
+    def ident(self, v):
+        if v != self._ident:
+            self._ident = v
+            self._version += 1
+            self._dirty = True
+            _edited()
+
+    def _unshare(self):
+        self._fields = list(self._fields)
+        self._offsets = array.array('I', self._offsets)
+        self._comments = list(self._comments)
+        self._tagd = {k : list(v) for k, v in self._tagd.items()}
+        self._shared = False
+
+    def _ntokens(self):
+        return len(self._offsets) - 1
+
+    def dirty(self):
+        return self._dirty
+
+    # (file path, start, end) of the object in its raw file, or None
+    def span(self):
+        if self._start is None:
+            return None
+        return self.namespace.fpath, self._start, self._end
+
+    # Same for token i, or the object's header token if i is None. Token
+    # spans are worked out from the content, cp437 being one byte per
+    # character, so they are only available until the object is edited.
+    def token_span(self, i = None):
+        if self._start is None:
+            return None
+        if self._version:
+            raise ValueError('object {:s} was edited since it was read'.format(repr(self.ident)))
+        start = self._start + len(self._comment)
+        if i is None:
+            return self.namespace.fpath, start, start + len(self._token)
+        n = self._ntokens()
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError('token index out of range')
+        start += len(self._token)
+        fields = self._fields
+        offsets = self._offsets
+        for k in range(i):
+            a, b = offsets[k], offsets[k+1]
+            start += len(self._comments[k]) + sum(map(len, fields[a:b])) + (b - a) + 1
+        start += len(self._comments[i])
+        a, b = offsets[i], offsets[i+1]
+        return self.namespace.fpath, start, start + sum(map(len, fields[a:b])) + (b - a) + 1
+
+    def toknames(self):
+        return self._tagd.keys()
+
+    def _set_field(self, i, j, v):
+        if self._shared:
+            self._unshare()
+        start = self._offsets[i]
+        old = self._fields[start+j]
+        self._fields[start+j] = v
+        self._version += 1
+        self._dirty = True
+        _edited()
+        # renaming a token moves it in the name index
+        if j == 0 and v != old:
+            self._tagd[old].remove(i)
+            if not self._tagd[old]:
+                del self._tagd[old]
+            v = sys.intern(v)
+            self._fields[start] = v
+            if v in self._tagd:
+                self._tagd[v].append(i)
+                self._tagd[v].sort()
+            else:
+                self._tagd[v] = [i]
 
     def __getitem__(self, k):
         if isinstance(k, int):
-            return self._tags[k]
+            n = self._ntokens()
+            if k < 0:
+                k += n
+            if k < 0 or k >= n:
+                raise IndexError('token index out of range')
+            return Rtoken(self, k)
         elif isinstance(k, str):
-            return tuple(self._tags[i] for i in self._tagd[k])
+            return tuple(Rtoken(self, i) for i in self._tagd[k])
         else:
             raise ValueError('key must be int or str, got {:s}'.format(repr(k)))
 
+    def __iter__(self):
+        return (Rtoken(self, i) for i in range(self._ntokens()))
+
     def __contains__(self, k):
         if isinstance(k, str):
+            if self._view:
+                start = self._start + len(self._comment) + len(self._token)
+                return rawparse.hastoken(self.namespace._mm, start, self._end, k)
             return k in self._tagd
         else:
             raise ValueError('key msy be str, got {:s}'.format(repr(k)))
 
     def content(self):
         yield self._comment, '['+self.subtype+':'+self.ident+']', None, None
-        for c, t in zip(self._comments, self._tags):
-            yield c, '['+':'.join(t)+']', None, None
-        for i in range(len(self._tags), len(self._comments)):
+        fields = self._fields
+        offsets = self._offsets
+        ntokens = self._ntokens()
+        for i in range(ntokens):
+            yield self._comments[i], '['+':'.join(fields[offsets[i]:offsets[i+1]])+']', None, None
+        for i in range(ntokens, len(self._comments)):
             yield self._comments[i], '', None, None
 
 class Rnamespace(object):
-    def __init__(self, tup, verbosity = 0, strict = True):
-        name, objc, objt, content = tup
-        if not name.startswith(df_raw_ns_names[objt]):
-            if verbosity >= 0:
-                print('INVALID: namespace {:s} does not start with type {:s}'
-                      .format(repr(name), repr(df_raw_ns_names[objt])))
-            if strict:
-                raise ValueError('namespace {:s} does not start with type {:s}'
-                                 .format(repr(name), repr(df_raw_ns_names[objt])))
+    # tup is a readraw tuple; with readraw(offset=True) it also carries the
+    # content's byte offset, and objects then know their spans in fpath.
+    # With mapped, tup comes from rawparse.mapraw instead: the namespace
+    # keeps the mapping in self._mm and its objects are views into it,
+    # decoded one at a time when first used. The file must then be
+    # replaced rather than modified in place while the namespace is alive.
+    def __init__(self, tup, verbosity = 0, strict = True, diag = None, fpath = None,
+                 pool = None, mapped = False):
+        if diag is None:
+            diag = rawdiag.Rdiag(verbosity=verbosity, strict=strict)
+        name, objc, objt, content, *content_idx = tup
+        if not name.startswith(df_raw_ns_names.get(objt, '')):
+            diag.add('namespace-prefix', fpath, None, None, name, df_raw_ns_names[objt])
         self.name = name
+        self.fpath = fpath
+        # (mtime, size) of fpath when it was read, see tofile
+        self._fstat = None
         self.rawtype = objt
         self._comment = objc
         if objt in df_raw_types:
             self.subtypes = df_raw_types[objt]
         else:
             self.subtypes = {}
-            if verbosity >= 0:
-                print('INVALID: unrecognized raw object type {:s}'
-                      .format(repr(objt)))
-            if strict:
-                raise ValueError('invalid object type {:s}'
-                                 .format(repr(objt)))
+            diag.add('object-type', fpath, None, None, objt)
 
         self._objects = []
         self._idents = {}
         self._invalid = []
+        self._mm = None
+        self._pool = None
+        if mapped:
+            self._mm = content
+            self._pool = pool
+            for i, (start, end, head) in enumerate(rawparse.iterheads(content, content_idx[0],
+                                                                      self.subtypes)):
+                self._add_object([head], head[2], i, diag, fpath, (start, end), pool, view=True)
+            return
+
         current = []
         next_tokname = None
         i = 0
+        start = pos = content_idx[0] if content_idx else 0
         for x in content:
-            _, _, tokname, _ = x
+            comment, token, tokname, _ = x
             if next_tokname is None:
                 next_tokname = tokname
             if current and tokname in self.subtypes:
-                robj = Robject(current, ns=self, verbosity=verbosity)
-                ident = robj.ident
-                self._objects.append(robj)
-                if ident and next_tokname in self.subtypes:
-                    if ident in self._idents:
-                        self._idents[ident].append(i)
-                        if strict:
-                            raise ValueError('duplicate ident {:s}'
-                                             .format(repr(ident)))
-                    else:
-                        self._idents[ident] = [i]
-                elif strict:
-                    raise ValueError('unrecognized subtype {:s} for ident {:s}'
-                                     .format(repr(next_tokname), repr(ident)))
-                else:
-                    self._invalid.append(i)
+                self._add_object(current, next_tokname, i, diag, fpath,
+                                 (start, pos) if content_idx else None, pool)
                 current = []
                 next_tokname = tokname
+                start = pos
                 i += 1
             current.append(x)
+            pos += len(comment) + len(token)
         if current:
-            robj = Robject(current, ns=self, verbosity=verbosity)
-            ident = robj.ident
-            self._objects.append(robj)
-            if ident and next_tokname in self.subtypes:
-                if ident in self._idents:
-                    self._idents[ident].append(i)
-                    if strict:
-                        raise ValueError('duplicate ident {:s}'
-                                         .format(repr(ident)))
-                else:
-                    self._idents[ident] = [i]
-            elif strict:
-                raise ValueError('unrecognized subtype {:s} for ident {:s}'
-                                 .format(repr(next_tokname), repr(ident)))
+            self._add_object(current, next_tokname, i, diag, fpath,
+                             (start, pos) if content_idx else None, pool)
+
+    def _add_object(self, current, tokname, i, diag, fpath, span, pool, view = False):
+        robj = Robject(current, ns=self, diag=diag, fpath=fpath, span=span, pool=pool, view=view)
+        offset = None if span is None else span[0]
+        ident = robj.ident
+        self._objects.append(robj)
+        if ident and tokname in self.subtypes:
+            if ident in self._idents:
+                self._idents[ident].append(i)
+                diag.add('duplicate-ident', fpath, offset, ident, ident)
             else:
-                self._invalid.append(i)
-            current = []
-            i += 1
+                self._idents[ident] = [i]
+        else:
+            self._invalid.append(i)
+            # a missing ident was already reported by the object itself
+            if tokname not in self.subtypes:
+                diag.add('unknown-subtype', fpath, offset, ident, tokname, ident)
 
     def __getitem__(self, k):
         if isinstance(k, int):
@@ -234,28 +545,299 @@ class Rnamespace(object):
         else:
             raise ValueError('key msy be str, got {:s}'.format(repr(k)))
 
-    def tofile(self, fpath, verbosity = 0):
+    def _reident(self, robj, old, new):
+        for i in self._idents.get(old, ()):
+            if self._objects[i] is robj:
+                break
+        else:
+            return
+        self._idents[old].remove(i)
+        if not self._idents[old]:
+            del self._idents[old]
+        if new in self._idents:
+            bisect.insort(self._idents[new], i)
+        else:
+            self._idents[new] = [i]
+
+    def dirty(self):
+        return [robj for robj in self._objects if robj._dirty]
+
+    # the mapping does not travel; the objects decode themselves on the way out
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mm'] = None
+        state['_pool'] = None
+        return state
+
+    # the source file can stand in for the clean objects as long as it
+    # still looks like it did when it was read
+    def _patchable(self):
+        return (self._fstat is not None
+                and os.path.isfile(self.fpath) and raw_fstat(self.fpath) == self._fstat
+                and all(robj._start is not None for robj in self._objects))
+
+    # With patch, writing a namespace back over the file it was read from,
+    # unchanged since, copies the file and splices in only the dirty
+    # objects, re-encoded with the file's own line endings; with nothing
+    # dirty it does nothing at all. Anything else, such as an export to
+    # another directory, encodes the whole namespace.
+    def tofile(self, fpath, verbosity = 0, skip_unchanged = False, patch = True):
+        target = rawparse.raw_target(fpath, self.name, verbosity=-1)
+        if (patch and os.path.isfile(target) and self._patchable()
+            and os.path.samefile(target, self.fpath)):
+            if self._mm is None:
+                newline = rawparse.fnewline(self.fpath)
+            else:
+                newline = rawparse.newline(self._mm)
+            patches = [(robj._start, robj._end, rawparse.encodecontent(robj.content(), newline))
+                       for robj in self.dirty()]
+            written = rawparse.patchraw(fpath, self.fpath, self.name, self.rawtype, patches,
+                                        verbosity=verbosity, skip_unchanged=skip_unchanged,
+                                        buf=self._mm)
+            if written:
+                self._patched(patches)
+            return written
+
         tup = self.name, self._comment, self.rawtype, (x for robj in self._objects 
                                                        for x in robj.content())
-        rawparse.writeraw(fpath, tup, verbosity=verbosity)
+        return rawparse.writeraw(fpath, tup, verbosity=verbosity,
+                                 skip_unchanged=skip_unchanged)
+
+    # after patching the source file in place, move every span to match it
+    def _patched(self, patches):
+        sizes = {start : len(data) for start, _, data in patches}
+        delta = 0
+        for robj in self._objects:
+            start = robj._start + delta
+            if robj._start in sizes:
+                end = start + sizes[robj._start]
+                robj._dirty = False
+            else:
+                end = robj._end + delta
+            delta = end - robj._end
+            robj._start, robj._end = start, end
+        self._fstat = raw_fstat(self.fpath)
+        # views still waiting to be decoded read the new file at their new spans
+        if self._mm is not None:
+            with open(self.fpath, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 def is_raw_fpath(fpath):
     return fpath.endswith('.txt') and os.path.isfile(fpath)
 
+def raw_fpaths(rawroot):
+    return list(filter(is_raw_fpath,
+                       (os.path.join(rawroot, fname) for fname in os.listdir(rawroot))))
+
+def raw_fstat(fpath):
+    st = os.stat(fpath)
+    return st.st_mtime_ns, st.st_size
+
+def raw_digest(fpath):
+    with open(fpath, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+# with zerocopy the file stays mapped and objects are views into it, see Rnamespace
+def read_rns(fpath, verbosity = 0, strict = True, engine = None, stats = None, diag = None,
+             pool = None, zerocopy = False):
+    if verbosity >= 2:
+        print('processing raw file {:s}'.format(repr(fpath)))
+    if diag is None:
+        diag = rawdiag.Rdiag(verbosity=verbosity, strict=strict)
+    # taken first, so a change while reading can only make tofile re-encode
+    fstat = raw_fstat(fpath)
+    if zerocopy:
+        if stats is None:
+            tup = rawparse.mapraw(fpath, verbosity=verbosity, diag=diag)
+        else:
+            with stats.timer('read', fpath=fpath):
+                tup = rawparse.mapraw(fpath, verbosity=verbosity, diag=diag)
+            stats.count(fpath, bytes=len(tup[3]))
+    else:
+        tup = rawparse.readraw(fpath, verbosity=verbosity, engine=engine, stats=stats,
+                               diag=diag, offset=True)
+    if stats is None:
+        rns = Rnamespace(tup, diag=diag, fpath=fpath, pool=pool, mapped=zerocopy)
+    else:
+        with stats.timer('split', fpath=fpath):
+            rns = Rnamespace(tup, diag=diag, fpath=fpath, pool=pool, mapped=zerocopy)
+        stats.count(fpath, objects=len(rns._objects))
+    rns._fstat = fstat
+    return rns
+
+# worker side of a parallel build: each process records into its own Rdiag
+# (and Rstats, if any), which the parent merges
+def _read_rns_worker(fpath, verbosity, engine, diag, stats, pool):
+    rns = read_rns(fpath, verbosity=verbosity, engine=engine, stats=stats, diag=diag, pool=pool)
+    return rns, diag, stats
+
+def _make_diag(diag, verbosity, strict):
+    if diag is None or diag is False:
+        return rawdiag.Rdiag(verbosity=verbosity, strict=strict)
+    elif diag is True:
+        return rawdiag.Rdiag(verbosity=verbosity, strict=strict, collect=True)
+    return diag
+
 class Rindex(object):
-    def __init__(self, rawroot = None, verbosity = 0, strict = True):
+    # stats can be True, or an rawstats.Rstats to also ask for a cProfile
+    # or tracemalloc capture of the build; it ends up in self.stats.
+    # Problems are recorded in self.diag, a rawdiag.Rdiag; diag=True
+    # collects them all without raising, even when strict.
+    # Strings are interned through self.pool, a new Rpool unless one is
+    # given to share between indices; pool=False turns interning off.
+    # With zerocopy every file stays mapped and objects are only decoded
+    # when first used, see Rnamespace; files are then read serially.
+    def __init__(self, rawroot = None, verbosity = 0, strict = True, workers = None,
+                 engine = None, lazy = False, stats = None, diag = None, pool = None,
+                 zerocopy = False):
         self.verbosity = verbosity
         self.strict = strict
+        self.workers = workers
+        self.engine = engine
+        self.zerocopy = zerocopy
+        self.stats = rawstats.Rstats() if stats is True else (stats or None)
+        self.diag = _make_diag(diag, verbosity, strict)
+        self.pool = Rpool() if pool is None else (None if pool is False else pool)
+        # only a pool of our own is pruned, see Rpool
+        self._own_pool = pool is None
         if rawroot is not None:
+            if self.stats is None:
+                self._open(rawroot, lazy)
+            else:
+                with self.stats.capture():
+                    self._open(rawroot, lazy)
+
+    def _open(self, rawroot, lazy):
+        if lazy:
+            self._open_lazy(rawroot)
+        else:
             self._create_from_root(rawroot)
 
+    # In lazy mode only file headers are read up front. Attributes that
+    # depend on unparsed files (namespaces, objects, the mangled subtype
+    # indices and the creature subindex) are left unset, so the first
+    # access lands here and parses just the files it needs.
+    def __getattr__(self, name):
+        pending = self.__dict__.get('_pending')
+        if not pending or name.startswith('__'):
+            raise AttributeError(name)
+        if name in ('namespaces', 'objects'):
+            self._load()
+        elif name in ('creature_B', 'creature_G', 'creature_M', 'cv_G', 'cv_M'):
+            self._load(self._rawtypes_of('CREATURE'))
+        else:
+            self._load(self._rawtypes_of(name.upper()))
+        if name in self.__dict__:
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _rawtypes_of(self, subtype):
+        rawtypes = {subtype}
+        for rawtype, subtypes in df_raw_types.items():
+            if subtype in subtypes:
+                rawtypes.add(rawtype)
+        return rawtypes
+
+    def _open_lazy(self, rawroot):
+        if not os.path.isdir(rawroot):
+            raise FileNotFoundError('no raw directory {:s}'.format(repr(rawroot)))
+        self.rawroot = rawroot
+
+        self._setup_index()
+        self._sources = {}
+        self._lazy_namespaces = []
+        self._lazy_objects = []
+        for fpath in raw_fpaths(rawroot):
+            # warnings are reported when the file is actually parsed
+            _, _, objt = rawparse.readheader(fpath, verbosity=-1)
+            self._pending.append((fpath, objt))
+
+        if self.verbosity >= 1:
+            print('opened lazy index of raws at {:s}'.format(rawroot))
+            print('  {:d} files pending'.format(len(self._pending)))
+
+    def _load(self, rawtypes = None):
+        if not self._pending:
+            return
+        load = [(fpath, objt) for fpath, objt in self._pending
+                if rawtypes is None or objt in rawtypes]
+        if not load:
+            return
+        fpaths = [fpath for fpath, _ in load]
+        fstats = [raw_fstat(fpath) for fpath in fpaths]
+        namespaces = self._read_all(fpaths)
+
+        for fpath, fstat, rns in zip(fpaths, fstats, namespaces):
+            self._sources[fpath] = fstat, rns
+        if 'creature_B' not in self.__dict__ and any(objt == 'CREATURE' for _, objt in load):
+            self._setup_creature_subindex()
+        if self.stats is None:
+            self._patch_index([], namespaces)
+        else:
+            with self.stats.timer('index'):
+                self._patch_index([], namespaces)
+        self._lazy_namespaces.extend(namespaces)
+        self._lazy_objects.extend(robj for rns in namespaces for robj in rns)
+        self._pending = [x for x in self._pending if x not in load]
+        self._setup_derived()
+
+        if not self._pending:
+            self.namespaces = self._lazy_namespaces
+            self.objects = self._lazy_objects
+            del self._lazy_namespaces
+            del self._lazy_objects
+            if 'creature_B' not in self.__dict__:
+                self._setup_creature_subindex()
+
+        if self.verbosity >= 1:
+            print('loaded {:d} raw files, {:d} pending'
+                  .format(len(load), len(self._pending)))
+
     def _setup_index(self):
+        # forget names mangled by a previous build
+        for k in getattr(self, '_mangled_names', ()):
+            del self.__dict__[k.lower()]
         # namespace index: name -> raw namespace object
         self._rns_index = {}
         # object master index: type or subtype -> raw object
         self._robj_master = {}
         # name mangling
         self._mangled_names = set()
+        # number of duplicate namespaces / idents that were ignored
+        self._shadowed = 0
+        # lazy mode: (file path, object type) of files not parsed yet
+        self._pending = []
+        self._setup_derived()
+
+    def _setup_derived(self):
+        # inverted tag indices, built on first query
+        self._tok_index = None
+        self._arg_index = None
+        # reference graph, built on first query
+        self._ref_index = None
+        self._user_index = None
+        # expanded creatures: raw object -> (dependencies, Rview)
+        self._expanded = {}
+        # numeric columns: (token name, argument position, subtype) -> columns
+        self._columns = {}
+        # _edits, and the sum of the objects' versions, when the above were
+        # last known to be in sync with the objects
+        self._edits_seen = _edits
+        self._versions_seen = None
+
+    # Objects edited directly, through Rtoken or Robject.ident, bump their
+    # _version and the module's edit count, but do not know which indices
+    # hold them. Derived data is trusted while the count is unchanged, or
+    # while this index's versions still add up the same (they only go up);
+    # otherwise it is dropped and rebuilt on next use.
+    def _check_edits(self):
+        if self._edits_seen == _edits:
+            return
+        versions = sum(robj._version for robj in self.objects)
+        if versions != self._versions_seen:
+            self._setup_derived()
+        self._edits_seen = _edits
+        self._versions_seen = versions
 
     def _mangle_names(self):
         for k in self._robj_master:
@@ -265,12 +847,8 @@ class Rindex(object):
     def _add_rns(self, rns):
         name = rns.name
         if name in self._rns_index:
-            if self.verbosity >= 0:
-                print('duplicate namespace {:s}, ignoring'
-                      .format(repr(name)))
-            if self.strict:
-                raise ValueError('duplicate namespace {:s}'
-                                 .format(repr(name)))
+            self._shadowed += 1
+            self.diag.add('duplicate-namespace', rns.fpath, None, None, name)
         else:
             self._rns_index[name] = rns
                 
@@ -283,14 +861,13 @@ class Rindex(object):
             self._robj_master[subtype] = {}
         robj_index = self._robj_master[subtype]
         if ident in robj_index:
-            if self.verbosity >= 0:
-                print('duplicate ident {:s} for subtype {:s}, ignoring'
-                      .format(repr(ident), repr(subtype)))
-            if self.strict:
-                raise ValueError('duplicate ident {:s} for subtype {:s}'
-                                 .format(repr(ident), repr(subtype)))
+            self._shadowed += 1
+            self.diag.add('duplicate-subtype-ident', robj.namespace.fpath, robj._start, ident,
+                          ident, subtype)
+            indexed = False
         else:
             robj_index[ident] = robj
+            indexed = True
 
         # special case for items
         if rawtype == 'ITEM':
@@ -298,29 +875,124 @@ class Rindex(object):
                 self._robj_master[rawtype] = {}
             robj_index = self._robj_master[rawtype]
             if ident in robj_index:
-                if self.verbosity >= 0:
-                    print('duplicate ident {:s} for rawtype {:s}, ignoring'
-                          .format(repr(ident), repr(rawtype)))
-                if self.strict:
-                    raise ValueError('duplicate ident {:s} for rawtype {:s}'
-                                     .format(repr(ident), repr(rawtype)))
+                self._shadowed += 1
+                self.diag.add('duplicate-rawtype-ident', robj.namespace.fpath, robj._start,
+                              ident, ident, rawtype)
             else:
                 robj_index[ident] = robj
 
-    def _create_from_root(self, rawroot):
+        return indexed
+
+    def _remove_rns(self, rns):
+        if self._rns_index.get(rns.name) is rns:
+            del self._rns_index[rns.name]
+        for robj in rns:
+            self._remove_robj(robj)
+
+    def _remove_robj(self, robj):
+        removed = False
+        for k in (robj.subtype, robj.namespace.rawtype):
+            robj_index = self._robj_master.get(k, {})
+            if robj_index.get(robj.ident) is robj:
+                del robj_index[robj.ident]
+                removed = True
+        if robj.subtype == 'CREATURE':
+            self._remove_creature(robj.ident, robj)
+        return removed
+
+    def _read_all(self, fpaths):
+        # mappings cannot be sent back from a worker, and there is little to parallelize
+        if self.workers is None or self.workers <= 1 or len(fpaths) <= 1 or self.zerocopy:
+            return [read_rns(fpath, verbosity=self.verbosity, engine=self.engine,
+                             stats=self.stats, diag=self.diag, pool=self.pool,
+                             zerocopy=self.zerocopy)
+                    for fpath in fpaths]
+        # map preserves order, so merging below is the same as a serial build.
+        # Workers intern into pools of their own, which keeps what they send
+        # back small, and the parent moves everything over to self.pool.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            namespaces = []
+            for rns, diag, stats in pool.map(_read_rns_worker, fpaths,
+                                             itertools.repeat(self.verbosity),
+                                             itertools.repeat(self.engine),
+                                             itertools.repeat(self.diag.fresh()),
+                                             itertools.repeat(self.stats and rawstats.Rstats()),
+                                             itertools.repeat(None if self.pool is None else Rpool())):
+                self.diag.merge(diag)
+                if stats is not None:
+                    self.stats.merge(stats)
+                if self.pool is not None:
+                    for robj in rns:
+                        self.pool.adopt(robj)
+                namespaces.append(rns)
+            return namespaces
+
+    def _cached_rns(self, fpath, fstat, sources, digests):
+        if fpath not in sources:
+            return None
+        old_fstat, rns = sources[fpath]
+        if fstat == old_fstat:
+            return rns
+        _, size = fstat
+        _, old_size = old_fstat
+        if size == old_size and fpath in digests and raw_digest(fpath) == digests[fpath]:
+            # same bytes under a new mtime, so the file can still be patched
+            rns._fstat = fstat
+            return rns
+        return None
+
+    def _create_from_root(self, rawroot, sources = None, digests = None):
         if not os.path.isdir(rawroot):
             raise FileNotFoundError('no raw directory {:s}'.format(repr(rawroot)))
         self.rawroot = rawroot
+        if sources is None:
+            sources = {}
+        if digests is None:
+            digests = {}
+
+        fpaths = raw_fpaths(rawroot)
+        fstats = [raw_fstat(fpath) for fpath in fpaths]
+        cached = [self._cached_rns(fpath, fstat, sources, digests)
+                  for fpath, fstat in zip(fpaths, fstats)]
+        # problems in files that are parsed again will be found again
+        self.diag.discard(fpaths=set(sources) - {fpath for fpath, rns in zip(fpaths, cached)
+                                                 if rns is not None})
+        parsed = iter(self._read_all([fpath for fpath, rns in zip(fpaths, cached)
+                                      if rns is None]))
+
+        # source index: file path -> ((mtime, size), raw namespace object)
+        self._sources = {}
+        namespaces = []
+        for fpath, fstat, rns in zip(fpaths, fstats, cached):
+            if rns is None:
+                rns = next(parsed)
+            elif self.verbosity >= 2:
+                print('reusing raw file {:s}'.format(repr(fpath)))
+            self._sources[fpath] = fstat, rns
+            namespaces.append(rns)
+
+        # nothing changed since the snapshot, so the old index is still good
+        if namespaces != getattr(self, 'namespaces', None):
+            self._build_index(namespaces)
+            # strings of files reused from a snapshot may be stale, a fresh build's are not
+            if sources:
+                self._prune_pool()
+            elif self._own_pool and self.pool is not None:
+                self.pool.pruned = len(self.pool.strs)
 
+        if self.verbosity >= 1:
+            print('created index of raws at {:s}'.format(rawroot))
+            print('  {:d} namespaces, {:d} typed indices, {:d} objects'
+                  .format(len(self.namespaces), len(self._robj_master), len(self.objects)))
+
+    def _build_index(self, namespaces):
+        if self.stats is not None:
+            start = time.perf_counter()
+        self.diag.discard(codes=rawdiag.df_index_codes)
         self._setup_index()
         self.objects = []
         self.namespaces = []
-        for fpath in filter(is_raw_fpath, 
-                            (os.path.join(rawroot, fname) for fname in os.listdir(rawroot))):
-            if self.verbosity >= 2:
-                print('processing raw file {:s}'.format(repr(fpath)))
-            rns = Rnamespace(rawparse.readraw(fpath, verbosity=self.verbosity),
-                             verbosity=self.verbosity, strict=self.strict)
+        for rns in namespaces:
             self._add_rns(rns)
             self.namespaces.append(rns)
 
@@ -329,99 +1001,893 @@ class Rindex(object):
                 self.objects.append(robj)
 
         self._mangle_names()
-        self._setup_creature_subindex()
-
-        if self.verbosity >= 1:
-            print('created index of raws at {:s}'.format(rawroot))
-            print('  {:d} namespaces, {:d} typed indices, {:d} objects'
-                  .format(len(self.namespaces), len(self._robj_master), len(self.objects)))
+        if self.stats is None:
+            self._setup_creature_subindex()
+        else:
+            self.stats.add('index', time.perf_counter() - start)
+            with self.stats.timer('creature'):
+                self._setup_creature_subindex()
 
     def _setup_creature_subindex(self):
+        self.diag.discard(codes=('variation-parent',))
         self.creature_B = {}
         self.creature_G = {}
         self.creature_M = {}
         self.cv_G = {}
         self.cv_M = {}
 
-        for ident in self.creature:
-            robj = self.creature[ident]
-            if 'APPLY_CREATURE_VARIATION' in robj:
-                cv_toks = robj['APPLY_CREATURE_VARIATION']
-                if (has_tag(cv_toks, 'GIANT')
-                    or has_tag(cv_toks, 'ANIMAL_PERSON') or has_tag(cv_toks, 'ANIMAL_PERSON_LEGLESS')):
-                    try:
-                        cp_toks = robj['COPY_TAGS_FROM']
-                        assert len(cp_toks) == 1
-                        assert len(cp_toks[0]) == 2
-                        parent_ident = cp_toks[0][1]
-                    except Exception as e:
-                        print('WARNING: creature variation {:s} has invalid parent'
-                              .format(repr(ident)))
-                        if self.strict:
-                            raise e
-                        else:
-                            traceback.print_exc()
-                        parent_ident = None
-
-                    if has_tag(cv_toks, 'GIANT'):
-                        self.creature_G[ident] = robj
-                        if parent_ident is not None:
-                            self.cv_G[parent_ident] = ident
-                    if has_tag(cv_toks, 'ANIMAL_PERSON') or has_tag(cv_toks, 'ANIMAL_PERSON_LEGLESS'):
-                        self.creature_M[ident] = robj
-                        if parent_ident is not None:
-                            self.cv_M[parent_ident] = ident
-                    else:
-                        if self.verbosity >= 1:
-                            print('misc variation {:s}'.format(repr(ident)))
+        creatures = self._robj_master.get('CREATURE', {})
+        for ident in creatures:
+            self._add_creature(ident, creatures[ident])
+
+    def _add_creature(self, ident, robj):
+        if 'APPLY_CREATURE_VARIATION' in robj:
+            cv_toks = robj['APPLY_CREATURE_VARIATION']
+            if (has_tag(cv_toks, 'GIANT')
+                or has_tag(cv_toks, 'ANIMAL_PERSON') or has_tag(cv_toks, 'ANIMAL_PERSON_LEGLESS')):
+                cp_toks = robj['COPY_TAGS_FROM'] if 'COPY_TAGS_FROM' in robj else ()
+                if len(cp_toks) == 1 and len(cp_toks[0]) == 2:
+                    parent_ident = cp_toks[0][1]
                 else:
-                    self.creature_B[ident] = robj
+                    parent_ident = None
+                    self.diag.add('variation-parent', robj.namespace.fpath, robj._start,
+                                  ident, ident)
+
+                if has_tag(cv_toks, 'GIANT'):
+                    self.creature_G[ident] = robj
+                    if parent_ident is not None:
+                        self.cv_G[parent_ident] = ident
+                if has_tag(cv_toks, 'ANIMAL_PERSON') or has_tag(cv_toks, 'ANIMAL_PERSON_LEGLESS'):
+                    self.creature_M[ident] = robj
+                    if parent_ident is not None:
+                        self.cv_M[parent_ident] = ident
+                else:
+                    if self.verbosity >= 1:
+                        print('misc variation {:s}'.format(repr(ident)))
             else:
-                if self.verbosity >= 1:
-                    print('creature {:s} appears not to have gait variations'
-                          .format(repr(ident)))
                 self.creature_B[ident] = robj
+        else:
+            if self.verbosity >= 1:
+                print('creature {:s} appears not to have gait variations'
+                      .format(repr(ident)))
+            self.creature_B[ident] = robj
 
-    def todir(self, fpath):
+    def _remove_creature(self, ident, robj):
+        for creature_index in (self.creature_B, self.creature_G, self.creature_M):
+            if creature_index.get(ident) is robj:
+                del creature_index[ident]
+        if 'COPY_TAGS_FROM' in robj:
+            for cp_tok in robj['COPY_TAGS_FROM']:
+                for cv_index in (self.cv_G, self.cv_M):
+                    if len(cp_tok) == 2 and cv_index.get(cp_tok[1]) == ident:
+                        del cv_index[cp_tok[1]]
+
+    # incremental updates
+
+    def refresh(self):
+        self._load()
+        fpaths = raw_fpaths(self.rawroot)
+        fstats = {fpath : raw_fstat(fpath) for fpath in fpaths}
+        added = [fpath for fpath in fpaths if fpath not in self._sources]
+        changed = [fpath for fpath in fpaths
+                   if fpath in self._sources and self._sources[fpath][0] != fstats[fpath]]
+        removed = [fpath for fpath in self._sources if fpath not in fstats]
+        if not (added or changed or removed):
+            return added, changed, removed
+
+        # parse before touching the index, so a strict failure leaves it intact
+        old_records = self.diag.records
+        self.diag.discard(fpaths=set(changed + removed))
+        try:
+            parsed = dict(zip(added + changed, self._read_all(added + changed)))
+        except Exception:
+            self.diag.records = old_records
+            raise
+        old_sources = self._sources
+        old_namespaces = self.namespaces
+
+        self._sources = {}
+        namespaces = []
+        for fpath in fpaths:
+            if fpath in parsed:
+                self._sources[fpath] = fstats[fpath], parsed[fpath]
+            else:
+                self._sources[fpath] = old_sources[fpath]
+        # keep the existing namespace order, changed files in place and new
+        # files at the end, so the same duplicates win as before
+        old_fpaths = {id(rns) : fpath for fpath, (_, rns) in old_sources.items()}
+        for rns in old_namespaces:
+            fpath = old_fpaths.get(id(rns))
+            if fpath in parsed:
+                namespaces.append(parsed[fpath])
+            elif fpath in self._sources:
+                namespaces.append(rns)
+        for fpath in added:
+            namespaces.append(parsed[fpath])
+
+        # removing an object could uncover a shadowed duplicate, so rebuild
+        if self._shadowed:
+            self._build_index(namespaces)
+        else:
+            try:
+                self._patch_index([old_sources[fpath][1] for fpath in changed + removed],
+                                  [parsed[fpath] for fpath in changed + added])
+                # a new duplicate has to lose to whichever comes first in order
+                if self._shadowed:
+                    self._build_index(namespaces)
+                else:
+                    self.namespaces = namespaces
+                    self.objects = [robj for rns in namespaces for robj in rns]
+                    self._setup_derived()
+            except Exception:
+                self._sources = old_sources
+                self._build_index(old_namespaces)
+                raise
+
+        self._prune_pool()
+        if self.verbosity >= 1:
+            print('refreshed index of raws at {:s}'.format(self.rawroot))
+            print('  {:d} added, {:d} changed, {:d} removed'
+                  .format(len(added), len(changed), len(removed)))
+        return added, changed, removed
+
+    def _prune_pool(self):
+        pool = self.pool
+        if self._own_pool and pool is not None and len(pool.strs) > 2 * pool.pruned:
+            pool.prune(self.objects)
+
+    def _patch_index(self, old, new):
+        for rns in old:
+            self._remove_rns(rns)
+        for rns in new:
+            self._add_rns(rns)
+            for robj in rns:
+                if self._add_robj(robj) and robj.subtype == 'CREATURE':
+                    self._add_creature(robj.ident, robj)
+        self._mangle_names()
+
+    def watch(self, interval = 1.0, callback = None, stop = None):
+        while stop is None or not stop.is_set():
+            added, changed, removed = self.refresh()
+            if callback is not None and (added or changed or removed):
+                callback(self, added, changed, removed)
+            if stop is None:
+                time.sleep(interval)
+            else:
+                stop.wait(interval)
+
+    def _setup_tag_index(self):
+        objects = self.objects
+        # token index: token name -> positions in self.objects
+        self._tok_index = {}
+        # argument index: tag argument -> (position in self.objects, token position)
+        self._arg_index = {}
+        for n, robj in enumerate(objects):
+            for tokname in robj._tagd:
+                if tokname in self._tok_index:
+                    self._tok_index[tokname].append(n)
+                else:
+                    self._tok_index[tokname] = [n]
+            for i, tags in enumerate(robj):
+                for arg in tags[1:]:
+                    if arg in self._arg_index:
+                        self._arg_index[arg].append((n, i))
+                    else:
+                        self._arg_index[arg] = [(n, i)]
+
+    def reindex_tags(self):
+        self._setup_derived()
+
+    def find_tag(self, tag, search_args = False):
+        self._check_edits()
+        if self._tok_index is None:
+            self._setup_tag_index()
+        if search_args:
+            hits = set(self._tok_index.get(tag, ()))
+            hits.update(n for n, _ in self._arg_index.get(tag, ()))
+            hits = sorted(hits)
+        else:
+            hits = self._tok_index.get(tag, ())
+        return [self.objects[n] for n in hits]
+
+    def find_arg(self, arg):
+        self._check_edits()
+        if self._arg_index is None:
+            self._setup_tag_index()
+        return [(self.objects[n], i) for n, i in self._arg_index.get(arg, ())]
+
+    # queries, see rawquery for the language
+
+    # Estimated number of matching objects, from the token index: how many
+    # objects have the token (an upper bound for field comparisons), carry
+    # the argument, have the subtype, or live in the namespace.
+    # An upper bound on the objects pred matches. Only the token and arg
+    # counts are exact, so only they can be complemented for 'not'.
+    def _estimate(self, pred):
+        kind = pred.kind
+        if pred.negated:
+            if kind not in ('token', 'arg'):
+                return len(self.objects)
+        if kind in ('token', 'field'):
+            est = len(self._tok_index.get(pred.tokname, ()))
+        elif kind == 'arg':
+            est = len({n for n, _ in self._arg_index.get(pred.value, ())})
+        elif kind == 'subtype' and pred.op == '=':
+            est = len(self._robj_master.get(pred.value, ()))
+        elif kind == 'namespace' and pred.op == '=':
+            rns = self._rns_index.get(pred.value)
+            est = 0 if rns is None else len(rns._objects)
+        elif kind == 'ident' and pred.op == '=':
+            est = sum(1 for robj_index in self._robj_master.values() if pred.value in robj_index)
+        else:
+            est = len(self.objects)
+        if pred.negated:
+            est = len(self.objects) - est
+        return est
+
+    # The most selective positive token, field or arg predicate drives the
+    # query through the token or argument index; the others filter its
+    # candidates, most selective first. Without one, every object is scanned.
+    def _plan(self, q):
+        self._check_edits()
+        if self._tok_index is None:
+            self._setup_tag_index()
+        steps = sorted(((self._estimate(pred), pred) for pred in q.preds),
+                       key=lambda x: x[0])
+        driver = None
+        for k, (est, pred) in enumerate(steps):
+            if not pred.negated and pred.kind in ('token', 'field', 'arg'):
+                driver = steps.pop(k)
+                break
+        return driver, steps
+
+    def explain(self, text):
+        driver, filters = self._plan(rawquery.parse_query(text))
+        lines = []
+        if driver is None:
+            lines.append('scan {:d} objects'.format(len(self.objects)))
+        else:
+            est, pred = driver
+            lines.append('index {:s}: {:d} candidates'
+                         .format('arg ' + repr(pred.value) if pred.kind == 'arg' else pred.tokname,
+                                 est))
+            if pred.kind == 'field':
+                lines.append('filter {:s}: at most {:d}'.format(repr(pred), est))
+        for est, pred in filters:
+            lines.append('filter {:s}: at most {:d}'.format(repr(pred), est))
+        return lines
+
+    # Objects matching a query, or tuples of their fields for a select.
+    def query(self, text):
+        q = rawquery.parse_query(text)
+        driver, filters = self._plan(q)
+        steps = filters if driver is None else [driver] + filters
+        if any(est == 0 and not pred.negated and pred.kind in ('token', 'field', 'arg', 'subtype')
+               for est, pred in steps):
+            return []
+
+        objects = self.objects
+        if driver is None:
+            candidates = objects
+        else:
+            _, pred = driver
+            if pred.kind == 'arg':
+                hits = sorted({n for n, _ in self._arg_index[pred.value]})
+            else:
+                hits = self._tok_index[pred.tokname]
+            candidates = [objects[n] for n in hits]
+            if pred.kind == 'field':
+                candidates = [robj for robj in candidates if pred.match(robj)]
+
+        tests = [pred.test for _, pred in filters]
+        results = [robj for robj in candidates if all(test(robj) for test in tests)]
+        if q.fields is None:
+            return results
+        return [q.project(robj) for robj in results]
+
+    # Numeric argument pos of every tokname token, optionally only in objects
+    # of one subtype, as columns (objects, tokens, values, missing): the
+    # position in self.objects, the token position in that object, the value
+    # as a float, and whether it was absent or not a number. Columns are numpy
+    # arrays if numpy is available and array.array otherwise, and are cached
+    # until the index or any of its objects changes, see _check_edits.
+    def column(self, tokname, pos, subtype = None):
+        self._check_edits()
+        k = (tokname, pos, subtype)
+        if k in self._columns:
+            return self._columns[k]
+        if self._tok_index is None:
+            self._setup_tag_index()
+
+        objs = array.array('l')
+        toks = array.array('l')
+        values = array.array('d')
+        missing = array.array('b')
+        for n in self._tok_index.get(tokname, ()):
+            robj = self.objects[n]
+            if subtype is not None and robj.subtype != subtype:
+                continue
+            for i in robj._tagd[tokname]:
+                tags = robj[i]
+                try:
+                    v = float(tags[pos])
+                    m = 0
+                except (IndexError, ValueError):
+                    v = 0.0
+                    m = 1
+                objs.append(n)
+                toks.append(i)
+                values.append(v)
+                missing.append(m)
+
+        if numpy is not None:
+            cols = (numpy.asarray(objs),
+                    numpy.asarray(toks),
+                    numpy.asarray(values),
+                    numpy.asarray(missing).astype(bool))
+        else:
+            cols = objs, toks, values, missing
+        self._columns[k] = cols
+        return cols
+
+    # reference graph
+
+    def _setup_ref_index(self):
+        objects = self.objects
+        # reference index: raw object -> [(token position, argument position, subtype, ident)]
+        self._ref_index = {}
+        # user index: (subtype, ident) -> [(raw object, token position, argument position)]
+        self._user_index = {}
+        for robj in objects:
+            refs = []
+            for tokname in robj.toknames() & df_raw_refs.keys():
+                for i in robj._tagd[tokname]:
+                    tags = robj[i]
+                    n = len(tags)
+                    for pos, subtype in df_raw_refs[tokname]:
+                        if pos is None:
+                            positions = range(1, n)
+                        elif pos < 0:
+                            positions = (n + pos,)
+                        else:
+                            positions = (pos,)
+                        for j in positions:
+                            if 1 <= j < n:
+                                refs.append((i, j, subtype, tags[j]))
+            refs.sort()
+            self._ref_index[robj] = refs
+            for i, j, subtype, ident in refs:
+                k = (subtype, ident)
+                if k in self._user_index:
+                    self._user_index[k].append((robj, i, j))
+                else:
+                    self._user_index[k] = [(robj, i, j)]
+
+    # where an object is defined: (file path, start, end), or None
+    def locate(self, subtype, ident):
+        robj = self.resolve(subtype, ident)
+        if robj is None:
+            return None
+        return robj.span()
+
+    def resolve(self, subtype, ident):
+        if self._pending:
+            self._load(self._rawtypes_of(subtype))
+        return self._robj_master.get(subtype, {}).get(ident)
+
+    # what robj depends on: [(token position, argument position, subtype, ident, target or None)]
+    def references(self, robj):
+        self._check_edits()
+        if self._ref_index is None:
+            self._setup_ref_index()
+        return [(i, j, subtype, ident, self.resolve(subtype, ident))
+                for i, j, subtype, ident in self._ref_index.get(robj, ())]
+
+    # who uses an object, given as a raw object or by subtype and ident:
+    # [(raw object, token position, argument position)]
+    def users(self, robj_or_subtype, ident = None):
+        self._check_edits()
+        if self._user_index is None:
+            self._setup_ref_index()
+        if ident is None:
+            k = (robj_or_subtype.subtype, robj_or_subtype.ident)
+        else:
+            k = (robj_or_subtype, ident)
+        return list(self._user_index.get(k, ()))
+
+    # references to objects that are not in the index:
+    # [(raw object, token position, argument position, subtype, ident)]
+    def dangling(self):
+        self._check_edits()
+        if self._user_index is None:
+            self._setup_ref_index()
+        return [(robj, i, j, subtype, ident)
+                for (subtype, ident), users in self._user_index.items()
+                if self.resolve(subtype, ident) is None
+                for robj, i, j in users]
+
+    # creature expansion
+
+    # The effective tokens of a creature after COPY_TAGS_FROM,
+    # APPLY_CREATURE_VARIATION and the GO_TO_* insertion tags, as an Rview.
+    # Every creature in a chain is memoized, and a cached view is reused
+    # only while none of the objects it was built from have been edited.
+    def expand_creature(self, k):
+        robj = self.creature[k] if isinstance(k, str) else k
+        return self._expand(robj, set())[1]
+
+    def _expand(self, robj, stack):
+        if robj in self._expanded:
+            deps, view = self._expanded[robj]
+            if all(dep._version == version for dep, version in deps):
+                return deps, view
+        if robj in stack:
+            raise ValueError('cyclic COPY_TAGS_FROM through {:s}'
+                             .format(repr(robj.ident)))
+        stack.add(robj)
+
+        deps = [(robj, robj._version)]
+        tokens = []
+        cursor = None
+        for tags in robj:
+            name = tags[0]
+            if name == 'COPY_TAGS_FROM' and len(tags) > 1:
+                parent = self.resolve('CREATURE', tags[1])
+                if parent is None:
+                    continue
+                parent_deps, parent_view = self._expand(parent, stack)
+                deps.extend(parent_deps)
+                if cursor is None:
+                    tokens.extend(parent_view)
+                else:
+                    tokens[cursor:cursor] = parent_view
+                    cursor += len(parent_view)
+            elif name == 'APPLY_CREATURE_VARIATION' and len(tags) > 1:
+                cv = self.resolve('CREATURE_VARIATION', tags[1])
+                if cv is None:
+                    continue
+                deps.append((cv, cv._version))
+                tokens = apply_variation(tokens, cv, tuple(tags[2:]))
+                if cursor is not None:
+                    cursor = min(cursor, len(tokens))
+            elif name == 'GO_TO_END':
+                cursor = None
+            elif name == 'GO_TO_START':
+                cursor = 0
+            elif name == 'GO_TO_TAG':
+                target = tuple(tags[1:])
+                for n, t in enumerate(tokens):
+                    if t[:len(target)] == target:
+                        cursor = n
+                        break
+            elif cursor is None:
+                tokens.append(tuple(tags))
+            else:
+                tokens.insert(cursor, tuple(tags))
+                cursor += 1
+
+        stack.discard(robj)
+        deps = tuple(deps)
+        view = Rview(robj.subtype, robj.ident, tokens)
+        self._expanded[robj] = deps, view
+        return deps, view
+
+    # batched rewrites
+
+    # Apply substitution rules (tokname, pos, old, new) to every token in one
+    # pass. A tokname or pos of None matches any token or position; position 0
+    # is the token name, and position 1 of an object's header token is its
+    # ident. The first matching rule wins, all rules see the original values,
+    # and only the index entries of changed objects are updated.
+    # Returns the number of hits for each rule.
+    def rewrite(self, rules):
+        self._check_edits()
+        by_old = {}
+        for r, (tokname, pos, old, new) in enumerate(rules):
+            if old in by_old:
+                by_old[old].append((r, tokname, pos, new))
+            else:
+                by_old[old] = [(r, tokname, pos, new)]
+        hits = [0] * len(rules)
+
+        def match(v, tokname, pos):
+            for r, r_tokname, r_pos, new in by_old[v]:
+                if ((r_tokname is None or r_tokname == tokname)
+                    and (r_pos is None or r_pos == pos)):
+                    hits[r] += 1
+                    return new
+            return None
+
+        for n, robj in enumerate(self.objects):
+            touched = False
+            indexed = False
+            if robj.ident in by_old:
+                new = match(robj.ident, robj.subtype, 1)
+                if new is not None and new != robj.ident:
+                    indexed = self._remove_robj(robj)
+                    touched = True
+                    old = robj.ident
+                    robj.ident = new
+                    robj.namespace._reident(robj, old, new)
+                    # expanded views only depend on what they resolved, and
+                    # the new ident may resolve a reference that did not
+                    self._expanded = {}
+
+            fields = robj._fields
+            offsets = robj._offsets
+            for i in range(robj._ntokens()):
+                start = offsets[i]
+                tokname = fields[start]
+                for j in range(start, offsets[i+1]):
+                    v = fields[j]
+                    if v in by_old:
+                        new = match(v, tokname, j - start)
+                        if new is not None and new != v:
+                            if not touched:
+                                indexed = self._remove_robj(robj)
+                                touched = True
+                            robj._set_field(i, j - start, new)
+                            self._retag(n, i, j - start, v, new)
+
+            if touched:
+                self._ref_index = None
+                self._user_index = None
+                self._columns = {}
+                if indexed and self._add_robj(robj) and robj.subtype == 'CREATURE':
+                    self._add_creature(robj.ident, robj)
+
+        # the edits above were applied to the indices as they went
+        self._edits_seen = _edits
+        self._versions_seen = sum(robj._version for robj in self.objects)
+        return hits
+
+    def _retag(self, n, i, pos, old, new):
+        if self._tok_index is None:
+            return
+        if pos == 0:
+            if old not in self.objects[n]:
+                self._tok_index[old].remove(n)
+                if not self._tok_index[old]:
+                    del self._tok_index[old]
+            if new not in self._tok_index:
+                self._tok_index[new] = [n]
+            else:
+                hits = self._tok_index[new]
+                k = bisect.bisect_left(hits, n)
+                if k >= len(hits) or hits[k] != n:
+                    hits.insert(k, n)
+        else:
+            self._arg_index[old].remove((n, i))
+            if not self._arg_index[old]:
+                del self._arg_index[old]
+            if new in self._arg_index:
+                bisect.insort(self._arg_index[new], (n, i))
+            else:
+                self._arg_index[new] = [(n, i)]
+
+    # With update, write into an existing tree and leave files whose
+    # encoded bytes are already on disk untouched. Returns the namespaces
+    # that were actually written.
+    def todir(self, fpath, workers = None, update = False):
         if not fpath.endswith(os.sep):
             fpath += os.sep
         if not os.path.isdir(fpath):
             os.mkdir(fpath)
-        elif os.listdir(fpath):
+        elif os.listdir(fpath) and not update:
             print('ERROR: output directory {:s} is not empty, aborting'
                   .format(repr(fpath)))
             return
-        for ns in self.namespaces:
-            ns.tofile(fpath, verbosity=self.verbosity)
+
+        def tofile(ns):
+            return ns.tofile(fpath, verbosity=self.verbosity, skip_unchanged=update)
+
+        if workers is None or workers <= 1:
+            written = [tofile(ns) for ns in self.namespaces]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                written = list(pool.map(tofile, self.namespaces))
+        return [ns for ns, w in zip(self.namespaces, written) if w]
 
 def has_tag(tokens, tag):
     return any(tag in tok for tok in tokens)
 
-# def save_ridx(ridx, fname):
-#     with open(fname, 'wt') as f:
-#         ydump(ridx, f)
+# Read-only view of an object's effective tokens, as tuples of fields
+# with the token name first, supporting the same lookups as Robject.
+
+class Rview(object):
+    __slots__ = ('subtype', 'ident', '_tags', '_tagd')
+
+    def __init__(self, subtype, ident, tags):
+        self.subtype = subtype
+        self.ident = ident
+        self._tags = tuple(tags)
+        self._tagd = {}
+        for i, tags in enumerate(self._tags):
+            if tags[0] in self._tagd:
+                self._tagd[tags[0]].append(i)
+            else:
+                self._tagd[tags[0]] = [i]
+
+    def __getitem__(self, k):
+        if isinstance(k, (int, slice)):
+            return self._tags[k]
+        elif isinstance(k, str):
+            return tuple(self._tags[i] for i in self._tagd[k])
+        else:
+            raise ValueError('key must be int or str, got {:s}'.format(repr(k)))
+
+    def __iter__(self):
+        return iter(self._tags)
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, k):
+        if isinstance(k, str):
+            return k in self._tagd
+        else:
+            raise ValueError('key msy be str, got {:s}'.format(repr(k)))
+
+    def toknames(self):
+        return self._tagd.keys()
 
-# def load_ridx(fname):
-#     with open(fname, 'rt') as f:
-#         return yload(f)
+# creature variations
 
+def _cv_args(tags, args):
+    # substitute !ARGn, longest first so !ARG1 does not eat !ARG10
+    if not args or not any('!ARG' in t for t in tags):
+        return tuple(tags)
+    out = []
+    for t in tags:
+        for n in range(len(args), 0, -1):
+            t = t.replace('!ARG{:d}'.format(n), args[n-1])
+        out.append(t)
+    return tuple(out)
+
+def _cv_cond(tags, args):
+    # conditional CV tags start with an argument number and required value
+    if len(tags) < 3:
+        return False, ()
+    try:
+        n = int(tags[1])
+    except ValueError:
+        return False, ()
+    return 1 <= n <= len(args) and args[n-1] == tags[2], tags[3:]
+
+def _cv_convert(tokens, master, target, replacement):
+    if master is None or target is None:
+        return tokens
+    out = []
+    for tags in tokens:
+        if tags[0] == master:
+            args = ':'.join(tags[1:]).replace(target, replacement or '')
+            tags = (tags[0],) + (tuple(args.split(':')) if args else ())
+        out.append(tags)
+    return out
+
+# Apply a CREATURE_VARIATION object to a list of token tuples, with the
+# extra arguments given to APPLY_CREATURE_VARIATION. Handles the add, new,
+# remove and convert tags and their conditional (CTAG) forms.
+def apply_variation(tokens, cv, args = ()):
+    tokens = list(tokens)
+    convert = None
+    for tags in cv:
+        name = tags[0]
+        if convert is not None and name.startswith('CVCT_'):
+            if name == 'CVCT_MASTER' and len(tags) > 1:
+                convert[0] = tags[1]
+            elif name == 'CVCT_TARGET':
+                convert[1] = ':'.join(tags[1:])
+            elif name == 'CVCT_REPLACEMENT':
+                convert[2] = ':'.join(tags[1:])
+            continue
+        if convert is not None:
+            tokens = _cv_convert(tokens, *convert)
+            convert = None
+
+        if name in ('CV_ADD_CTAG', 'CV_NEW_CTAG', 'CV_REMOVE_CTAG', 'CV_CONVERT_CTAG'):
+            ok, rest = _cv_cond(tags, args)
+            if not ok:
+                continue
+            name = name.replace('CTAG', 'TAG')
+            tags = (name,) + tuple(rest)
+
+        if name in ('CV_ADD_TAG', 'CV_NEW_TAG') and len(tags) > 1:
+            tokens.append(_cv_args(tags[1:], args))
+        elif name == 'CV_REMOVE_TAG' and len(tags) > 1:
+            prefix = _cv_args(tags[1:], args)
+            tokens = [t for t in tokens if t[:len(prefix)] != prefix]
+        elif name == 'CV_CONVERT_TAG':
+            convert = [None, None, None]
+    if convert is not None:
+        tokens = _cv_convert(tokens, *convert)
+    return tokens
+
+# overlays
+
+# An index over an ordered stack of layers (vanilla first, then mods),
+# each an Rindex or a raw directory. A namespace in a later layer replaces
+# the one with the same name below it, and an object in a later layer
+# shadows any object with the same subtype and ident below it. Objects
+# are shared with the layers, never copied, so passing the same cache
+# dict to several overlays parses each directory only once. Because of
+# that sharing, overlays are read-only: rewrite a layer instead.
+
+class Roverlay(Rindex):
+    def __init__(self, layers, verbosity = 0, strict = True, cache = None, **kwargs):
+        super().__init__(verbosity=verbosity, strict=strict, **kwargs)
+        self.layers = []
+        for layer in layers:
+            if not isinstance(layer, Rindex):
+                rawroot = layer
+                if cache is not None and rawroot in cache:
+                    layer = cache[rawroot]
+                else:
+                    layer = Rindex(rawroot=rawroot, verbosity=verbosity, strict=strict, **kwargs)
+                    if cache is not None:
+                        cache[rawroot] = layer
+            self.layers.append(layer)
+        self._build_overlay()
+
+    def _build_overlay(self):
+        self._setup_index()
+        self._sources = {}
+        # namespace index: first position of a name, latest layer's namespace
+        for layer in self.layers:
+            for rns in layer.namespaces:
+                self._rns_index[rns.name] = rns
+        self.namespaces = list(self._rns_index.values())
+        # each layer's files as of this build, see refresh
+        self._layer_sources = [{fpath : rns for fpath, (_, rns) in layer._sources.items()}
+                               for layer in self.layers]
+
+        layer_of = {}
+        for n, layer in enumerate(self.layers):
+            for rns in layer.namespaces:
+                layer_of[rns] = n
+
+        # shadowed objects, lowest layer first
+        self.shadowed = []
+        for rns in sorted(self.namespaces, key=layer_of.get):
+            for robj in rns:
+                keys = [robj.subtype]
+                if rns.rawtype == 'ITEM':
+                    keys.append(rns.rawtype)
+                for k in keys:
+                    if k not in self._robj_master:
+                        self._robj_master[k] = {}
+                    robj_index = self._robj_master[k]
+                    old = robj_index.get(robj.ident)
+                    if old is None:
+                        robj_index[robj.ident] = robj
+                    elif layer_of[old.namespace] < layer_of[rns]:
+                        if self.verbosity >= 1:
+                            print('{:s} {:s} in {:s} shadows {:s}'
+                                  .format(k, repr(robj.ident), repr(rns.name),
+                                          repr(old.namespace.name)))
+                        robj_index[robj.ident] = robj
+                        if k == robj.subtype:
+                            self.shadowed.append(old)
+
+        hidden = set(self.shadowed)
+        self.objects = [robj for rns in self.namespaces for robj in rns
+                        if robj not in hidden]
+        self._mangle_names()
+        self._setup_creature_subindex()
+
+        if self.verbosity >= 1:
+            print('created overlay of {:d} layers'.format(len(self.layers)))
+            print('  {:d} namespaces, {:d} typed indices, {:d} objects, {:d} shadowed'
+                  .format(len(self.namespaces), len(self._robj_master),
+                          len(self.objects), len(self.shadowed)))
+
+    # Same result as Rindex.refresh, with the files of every layer together.
+    # A layer shared through cache may already have been refreshed by
+    # another overlay, so changes are worked out against what each layer
+    # held when this overlay was last built, not from layer.refresh().
+    def refresh(self):
+        added, changed, removed = [], [], []
+        for layer, old in zip(self.layers, self._layer_sources):
+            layer.refresh()
+            new = {fpath : rns for fpath, (_, rns) in layer._sources.items()}
+            added.extend(fpath for fpath in new if fpath not in old)
+            changed.extend(fpath for fpath in new if fpath in old and new[fpath] is not old[fpath])
+            removed.extend(fpath for fpath in old if fpath not in new)
+        if added or changed or removed:
+            self._build_overlay()
+        return added, changed, removed
+
+    def rewrite(self, rules):
+        raise TypeError('overlays share objects with their layers, rewrite a layer instead')
+
+# snapshots
+
+def save_ridx(ridx, fname):
+    ridx._load()
+    # only hash files that still look like what was indexed
+    digests = {}
+    for fpath, (fstat, _) in ridx._sources.items():
+        if os.path.isfile(fpath) and raw_fstat(fpath) == fstat:
+            digests[fpath] = raw_digest(fpath)
+    with open(fname, 'wb') as f:
+        pickle.dump((snapshot_version, digests, ridx), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_ridx(fname, rawroot = None, verbosity = 0, strict = True, workers = None,
+              engine = None, stats = None, diag = None):
+    ridx = None
+    if os.path.isfile(fname):
+        try:
+            with open(fname, 'rb') as f:
+                version, digests, ridx = pickle.load(f)
+        except Exception as e:
+            if verbosity >= 0:
+                print('WARNING: unreadable snapshot {:s}: {:s}'
+                      .format(repr(fname), str(e)))
+            ridx = None
+        else:
+            if version != snapshot_version or ridx.strict != strict:
+                if verbosity >= 1:
+                    print('snapshot {:s} is out of date, ignoring'.format(repr(fname)))
+                ridx = None
+
+    if ridx is None:
+        if rawroot is None:
+            raise FileNotFoundError('no usable snapshot {:s}'.format(repr(fname)))
+        return Rindex(rawroot=rawroot, verbosity=verbosity, strict=strict, workers=workers,
+                      engine=engine, stats=stats, diag=diag)
+
+    ridx.verbosity = verbosity
+    ridx.workers = workers
+    # edit counts are per process, the saved versions are still good
+    ridx._edits_seen = None
+    ridx.engine = engine
+    ridx.stats = rawstats.Rstats() if stats is True else (stats or None)
+    # records for files reused from the snapshot are kept from when they were parsed
+    if diag is not None:
+        old_diag = ridx.diag
+        ridx.diag = _make_diag(diag, verbosity, strict)
+        ridx.diag.merge(old_diag)
+    else:
+        ridx.diag.verbosity = verbosity
+    if rawroot is None:
+        rawroot = ridx.rawroot
+    if ridx.stats is None:
+        ridx._create_from_root(rawroot, sources=ridx._sources, digests=digests)
+    else:
+        with ridx.stats.capture():
+            ridx._create_from_root(rawroot, sources=ridx._sources, digests=digests)
+    return ridx
 
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) < 2:
-        #print('Usage: {:s} <RAWDIR> [YAML]'.format(os.path.basename(__file__)))
-        print('Usage: {:s} <RAWDIR> [OUTPUTDIR]'.format(os.path.basename(__file__)))
-        exit(1)
-    rawdir = sys.argv[1]
-
-    ridx = Rindex(rawroot=rawdir, verbosity=2, strict=True)
-
-    # if len(sys.argv) > 2:
-    #     idxname = sys.argv[2]
-    #     print('Saving raw index to {:s}'.format(idxname))
-    #     save_ridx(ridx, idxname)
-
-    if len(sys.argv) > 2:
-        outname = sys.argv[2]
+    import argparse
+    parser = argparse.ArgumentParser(description='index a directory of raws')
+    parser.add_argument('rawdir', metavar='RAWDIR')
+    parser.add_argument('outdir', metavar='OUTPUTDIR', nargs='?')
+    parser.add_argument('--stats', action='store_true',
+                        help='print per-phase timings and the slowest files')
+    parser.add_argument('--profile', action='store_true', help='also capture a cProfile of the build')
+    parser.add_argument('--memory', action='store_true', help='also track peak memory with tracemalloc')
+    parser.add_argument('--collect', action='store_true',
+                        help='report every problem at the end instead of stopping at the first')
+    parser.add_argument('--zerocopy', action='store_true',
+                        help='keep files mapped and only decode objects when they are used')
+    args = parser.parse_args()
+
+    stats = None
+    if args.stats or args.profile or args.memory:
+        stats = rawstats.Rstats(profile=args.profile, memory=args.memory)
+    diag = None
+    if args.collect:
+        diag = rawdiag.Rdiag(verbosity=-1, strict=True, collect=True)
+    ridx = Rindex(rawroot=args.rawdir, verbosity=2, strict=True, stats=stats, diag=diag,
+                  zerocopy=args.zerocopy)
+    if stats is not None:
+        print(stats.report())
+    if diag is not None:
+        print(diag.report())
+        diag.check()
+
+    if args.outdir is not None:
+        outname = args.outdir
         print('Saving new raws to {:s}'.format(outname))
         ridx.todir(outname)
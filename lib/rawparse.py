@@ -3,6 +3,9 @@
 import os
 import re
 import mmap
+import time
+
+import rawdiag
 
 df_raw_encoding = 'cp437'
 
@@ -32,12 +35,24 @@ def valid(name, objdata):
     obj_comment, obj_token, obj, obj_tags = objdata
     return obj == 'OBJECT' and len(obj_tags) == 1 and name.strip() != ''
 
-def crlf(buf):
-    return crlf_re.sub('\r\n'.encode(df_raw_encoding), buf)
+def crlf(buf, newline = b'\r\n'):
+    return crlf_re.sub(newline, buf)
+
+# the line ending a raw file uses, going by its first line; \r\n if it has none
+def newline(buf):
+    i = buf.find(b'\n')
+    if i == 0 or (i > 0 and buf[i-1:i] != b'\r'):
+        return b'\n'
+    return b'\r\n'
+
+def fnewline(fpath):
+    with open(fpath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return newline(mm)
 
 # parsing engine
 
-def parse(buf):
+def parse_header(buf):
     name_m = rawname_re.match(buf)
     if name_m:
         name = name_m.group(0)
@@ -58,85 +73,306 @@ def parse(buf):
         obj = b''
         content_idx = obj_idx
 
-    contexts = []
+    return (name.decode(df_raw_encoding),
+            (obj_comment.decode(df_raw_encoding),
+             obj_token.decode(df_raw_encoding),
+             obj.decode(df_raw_encoding),
+             tuple(tagm.group()[1:].decode(df_raw_encoding)
+                   for tagm in tag_re.finditer(obj_token, len(obj)+1))),
+            obj_idx, content_idx)
+
+def iterparse(buf, obj_idx, content_idx):
     lastidx = obj_idx
     for m in context_re.finditer(buf, content_idx):
         comment = m.group(1)
         token = m.group(2)
         tokname = m.group(3)
-        contexts.append(
-            (comment.decode(df_raw_encoding),
-             token.decode(df_raw_encoding),
-             tokname.decode(df_raw_encoding),
-             tuple(tagm.group()[1:].decode(df_raw_encoding)
-                   for tagm in tag_re.finditer(token, len(tokname)+1)))
-        )
+        yield (comment.decode(df_raw_encoding),
+               token.decode(df_raw_encoding),
+               tokname.decode(df_raw_encoding),
+               tuple(tagm.group()[1:].decode(df_raw_encoding)
+                     for tagm in tag_re.finditer(token, len(tokname)+1)))
         lastidx = m.end()
     lastcomment = buf[lastidx:].decode(df_raw_encoding)
     if lastcomment != '':
-        contexts.append((lastcomment, '', '', tuple()))
-    
-    return (name.decode(df_raw_encoding),
-            (obj_comment.decode(df_raw_encoding),
-             obj_token.decode(df_raw_encoding),
-             obj.decode(df_raw_encoding),
-             tuple(tagm.group()[1:].decode(df_raw_encoding)
-                   for tagm in tag_re.finditer(obj_token, len(obj)+1))),
-            contexts)
+        yield (lastcomment, '', '', tuple())
+
+# Alternative engine: decode the whole buffer once, then cut tokens out of
+# the str with find / split. cp437 is one byte per character, so offsets
+# are the same as in the regex engine and output is identical.
+
+def split_prepare(buf):
+    return bytes(buf).decode(df_raw_encoding)
+
+def split_parse_header(text):
+    name_end = text.find('\n')
+    if name_end >= 0:
+        obj_idx = name_end + 1
+        name = text[:obj_idx]
+    else:
+        name = ''
+        obj_idx = 0
+
+    start = text.find('[', obj_idx)
+    end = text.find(']', start) if start >= 0 else -1
+    if end >= 0:
+        fields = text[start+1:end].split(':')
+        obj_comment = text[obj_idx:start]
+        obj_token = text[start:end+1]
+        obj = fields[0]
+        obj_tags = tuple(fields[1:])
+        content_idx = end + 1
+    else:
+        obj_comment = ''
+        obj_token = ''
+        obj = ''
+        obj_tags = tuple()
+        content_idx = obj_idx
 
-def fparse(fname):
+    return name, (obj_comment, obj_token, obj, obj_tags), obj_idx, content_idx
+
+def split_iterparse(text, obj_idx, content_idx):
+    find = text.find
+    lastidx = obj_idx
+    idx = content_idx
+    while True:
+        start = find('[', idx)
+        if start < 0:
+            break
+        end = find(']', start)
+        if end < 0:
+            break
+        fields = text[start+1:end].split(':')
+        yield (text[idx:start],
+               text[start:end+1],
+               fields[0],
+               tuple(fields[1:]))
+        idx = lastidx = end + 1
+    lastcomment = text[lastidx:]
+    if lastcomment != '':
+        yield (lastcomment, '', '', tuple())
+
+def re_prepare(buf):
+    return buf
+
+# engine name -> (prepare buffer, parse header, iterate contexts)
+engines = {
+    're' : (re_prepare, parse_header, iterparse),
+    'split' : (split_prepare, split_parse_header, split_iterparse),
+}
+default_engine = 're'
+
+def get_engine(engine = None):
+    if engine is None:
+        engine = default_engine
+    if engine not in engines:
+        raise ValueError('unknown parsing engine {:s}'.format(repr(engine)))
+    return engines[engine]
+
+def parse(buf, engine = None):
+    prepare, header, contexts = get_engine(engine)
+    data = prepare(buf)
+    name, objdata, obj_idx, content_idx = header(data)
+    return name, objdata, list(contexts(data, obj_idx, content_idx))
+
+def fparse(fname, engine = None):
     with open(fname, 'rb') as f:
         with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-            return parse(mm)
-
-def readraw(fpath, verbosity = 0):
-    if not os.path.isfile(fpath):
-        raise FileNotFoundError('no raw file {:s}'.format(repr(fpath)))
+            return parse(mm, engine=engine)
 
+# problems go to diag, a rawdiag.Rdiag; without one they are just printed
+def checkraw(fpath, name, objdata, verbosity = 0, diag = None):
+    if diag is None:
+        diag = rawdiag.Rdiag(verbosity=verbosity)
+    obj_comment, obj_token, obj, obj_tags = objdata
     fname = os.path.basename(fpath)
     fname_fragments = fname.split('.')
     fname_cleaned = '.'.join(fname_fragments[:-1])
-    if verbosity >= 0 and fname_fragments[-1] != 'txt':
-        print('WARNING: raw file {:s} does not appear to have .txt extension'
-              .format(repr(fname)))
-
-    name, objdata, content = fparse(fpath)
-    obj_comment, obj_token, obj, obj_tags = objdata
+    if fname_fragments[-1] != 'txt':
+        diag.add('raw-extension', fpath, None, None, fname)
 
     name_cleaned = name.strip()
     name_fragments = name_cleaned.split()
-    if verbosity >= 0 and len(name_fragments) != 1:
-        print('WARNING: whitespace in raw filename {:s}'
-              .format(repr(name_cleaned)))
-    if verbosity >= 0 and name_cleaned != fname_cleaned:
-        print('WARNING: raw name {:s} does not agree with filename {:s}'
-              .format(repr(name_cleaned), repr(fname_cleaned)))
+    if len(name_fragments) != 1:
+        diag.add('raw-name-whitespace', fpath, None, None, name_cleaned)
+    if name_cleaned != fname_cleaned:
+        diag.add('raw-name-mismatch', fpath, None, None, name_cleaned, fname_cleaned)
 
-    if verbosity >= 0 and not valid(name, objdata):
-        print('WARNING: name or object token {:s} is invalid!'
-              .format(repr(obj_token)))
+    if not valid(name, objdata):
+        diag.add('raw-header-invalid', fpath, None, None, obj_token)
 
     if len(obj_tags) <= 0:
         obj_type = ''
-        if verbosity >= 0:
-            print('WARNING: object token {:s} does not have type'
-                  .format(repr(obj_token)))
+        diag.add('object-no-type', fpath, None, None, obj_token)
     else:
         obj_type = obj_tags[0]
-        if verbosity >= 0 and len(obj_tags) > 1:
-            print('WARNING: object token {:s} has more than one argument'
-                  .format(repr(obj_token)))
+        if len(obj_tags) > 1:
+            diag.add('object-many-args', fpath, None, None, obj_token)
+
+    return name_cleaned, obj_type
+
+def _itercontent(mm, contexts):
+    try:
+        for x in contexts:
+            comment, token, _, _ = x
+            # same as readraw: drop a trailing whitespace-only comment
+            if token == '' and comment.strip() == '':
+                continue
+            yield x
+    finally:
+        mm.close()
+
+# Like readraw, but the content is a generator, so callers can stop early.
+# With the regex engine it scans the still-open mmap and decodes lazily;
+# the mapping is released when the generator is exhausted or closed.
+# stats, if given, is a rawstats.Rstats; timings are only taken when it is.
+# With offset=True the byte offset where the content starts is appended
+# to the result; each context then covers len(comment) + len(token) bytes.
+def iterraw(fpath, verbosity = 0, engine = None, stats = None, diag = None, offset = False):
+    if not os.path.isfile(fpath):
+        raise FileNotFoundError('no raw file {:s}'.format(repr(fpath)))
+
+    prepare, header, contexts = get_engine(engine)
+    if stats is not None:
+        start = time.perf_counter()
+    with open(fpath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if stats is not None:
+        read = time.perf_counter()
+        stats.add('read', read - start, fpath=fpath)
+        stats.count(fpath, bytes=len(mm))
+    data = prepare(mm)
+    if data is not mm:
+        mm.close()
+    if stats is not None:
+        stats.add('decode', time.perf_counter() - read, fpath=fpath)
+    name, objdata, obj_idx, content_idx = header(data)
+    obj_comment, _, _, _ = objdata
+    name_cleaned, obj_type = checkraw(fpath, name, objdata, verbosity=verbosity, diag=diag)
+
+    content = _itercontent(mm, contexts(data, obj_idx, content_idx))
+    if offset:
+        return name_cleaned, obj_comment, obj_type, content, content_idx
+    return name_cleaned, obj_comment, obj_type, content
 
-    if content:
-        lastcomment, lasttoken, _, _ = content[-1]
-        if lasttoken == '' and lastcomment.strip() == '':
-            content.pop()
+# just the name, object comment and object type, without reading content
+def readheader(fpath, verbosity = 0, diag = None):
+    if not os.path.isfile(fpath):
+        raise FileNotFoundError('no raw file {:s}'.format(repr(fpath)))
+
+    with open(fpath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            name, objdata, _, _ = parse_header(mm)
+    obj_comment, _, _, _ = objdata
+    name_cleaned, obj_type = checkraw(fpath, name, objdata, verbosity=verbosity, diag=diag)
+    return name_cleaned, obj_comment, obj_type
+
+# Zero-copy reading: the mapping is left open and handed back with the
+# offset where content starts, and only what the caller asks for is
+# decoded, through iterheads and iterspan. The caller closes the mapping.
+def mapraw(fpath, verbosity = 0, diag = None):
+    if not os.path.isfile(fpath):
+        raise FileNotFoundError('no raw file {:s}'.format(repr(fpath)))
+
+    with open(fpath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        name, objdata, _, content_idx = parse_header(mm)
+        obj_comment, _, _, _ = objdata
+        name_cleaned, obj_type = checkraw(fpath, name, objdata, verbosity=verbosity, diag=diag)
+    except BaseException:
+        mm.close()
+        raise
+    return name_cleaned, obj_comment, obj_type, mm, content_idx
+
+def _decode_context(m):
+    token = m.group(2)
+    tokname = m.group(3)
+    return (m.group(1).decode(df_raw_encoding),
+            token.decode(df_raw_encoding),
+            tokname.decode(df_raw_encoding),
+            tuple(tagm.group()[1:].decode(df_raw_encoding)
+                  for tagm in tag_re.finditer(token, len(tokname)+1)))
+
+# Split mapped content into objects the way Rnamespace does, before each
+# token named in subtypes, decoding only the first context of each:
+# (start, end, first context) per object. Offsets match readraw's,
+# including dropping a trailing whitespace-only comment.
+def iterheads(buf, content_idx, subtypes):
+    subtypes = {subtype.encode(df_raw_encoding) for subtype in subtypes}
+    head = None
+    start = lastidx = content_idx
+    for m in context_re.finditer(buf, content_idx):
+        if head is None:
+            head = m
+        elif m.group(3) in subtypes:
+            yield start, m.start(), _decode_context(head)
+            head = m
+            start = m.start()
+        lastidx = m.end()
+    lastcomment = buf[lastidx:].decode(df_raw_encoding)
+    end = lastidx if lastcomment.strip() == '' else len(buf)
+    if head is not None:
+        yield start, end, _decode_context(head)
+    elif end > content_idx:
+        yield start, end, (lastcomment, '', '', tuple())
+
+# the contexts between two offsets, such as the rest of an object after its header
+def iterspan(buf, start, end):
+    lastidx = start
+    for m in context_re.finditer(buf, start, end):
+        yield _decode_context(m)
+        lastidx = m.end()
+    if lastidx < end:
+        yield buf[lastidx:end].decode(df_raw_encoding), '', '', tuple()
+
+# whether a token named tokname lies between two offsets, without decoding;
+# find rules out most objects before the regex has to confirm a hit
+def hastoken(buf, start, end, tokname):
+    try:
+        tokname = tokname.encode(df_raw_encoding)
+    except UnicodeEncodeError:
+        return False
+    if buf.find(b'['+tokname+b':', start, end) < 0 and buf.find(b'['+tokname+b']', start, end) < 0:
+        return False
+    return any(m.group(3) == tokname for m in context_re.finditer(buf, start, end))
+
+# stop a content stream before the (n+1)th token whose name is in subtypes
+def takeobjects(content, subtypes, n):
+    seen = 0
+    try:
+        for x in content:
+            _, _, tokname, _ = x
+            if tokname in subtypes:
+                seen += 1
+                if seen > n:
+                    break
+            yield x
+    finally:
+        if hasattr(content, 'close'):
+            content.close()
+
+def readraw(fpath, verbosity = 0, engine = None, stats = None, diag = None, offset = False):
+    name, obj_comment, obj_type, contexts, *content_idx = iterraw(
+        fpath, verbosity=verbosity, engine=engine, stats=stats, diag=diag, offset=offset)
+    if stats is None:
+        content = list(contexts)
+    else:
+        with stats.timer('scan', fpath=fpath):
+            content = list(contexts)
+        stats.count(fpath, tokens=len(content))
 
     if verbosity >= 1:
         print('read {:s}, {:s}, {:d} tokens'
-              .format(fname, obj_token, len(content)))
+              .format(os.path.basename(fpath), '[OBJECT:'+obj_type+']', len(content)))
 
-    return name_cleaned, obj_comment, obj_type, content
+    return (name, obj_comment, obj_type, content, *content_idx)
+
+# the bytes between two offsets in a raw file, such as an object's span
+def readspan(fpath, start, end):
+    with open(fpath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[start:end]
 
 # complement to parse
 def unparse(tup):
@@ -156,9 +392,81 @@ def encoderaw(tup):
          content)
     )
 
-# write valid readraw tuple to file
-def writeraw(fpath, tup, verbosity = 0):
+# encode a valid readraw tuple in chunks of roughly chunk_size characters,
+# so content can be a generator and the whole file is never in memory
+def iterencoderaw(tup, chunk_size = 1 << 16):
     name, objc, objt, content = tup
+    pieces = [name + '\n', objc, '[OBJECT:'+objt+']']
+    size = sum(map(len, pieces))
+    for c, t, _, _ in content:
+        pieces.append(c)
+        pieces.append(t)
+        size += len(c) + len(t)
+        if size >= chunk_size:
+            chunk = ''.join(pieces)
+            # hold back a trailing \r, it might be half of a \r\n
+            if chunk.endswith('\r'):
+                chunk = chunk[:-1]
+                pieces = ['\r']
+                size = 1
+            else:
+                pieces = []
+                size = 0
+            if chunk:
+                yield crlf(chunk.encode(df_raw_encoding))
+    chunk = ''.join(pieces)
+    if chunk:
+        yield crlf(chunk.encode(df_raw_encoding))
+
+def _copy_prefix(src, dst, n, bufsize = 1 << 16):
+    src.seek(0)
+    while n > 0:
+        buf = src.read(min(n, bufsize))
+        dst.write(buf)
+        n -= len(buf)
+
+# Write to a temporary file next to fpath, then rename over it.
+# With skip_unchanged, chunks are first compared against the existing file,
+# and nothing is written at all if they match it exactly.
+def atomic_write(fpath, chunks, skip_unchanged = False):
+    tmp_fpath = '{:s}.{:d}.tmp'.format(fpath, os.getpid())
+    old = None
+    f = None
+    try:
+        if skip_unchanged and os.path.isfile(fpath):
+            old = open(fpath, 'rb')
+        matched = 0
+        for chunk in chunks:
+            if f is None:
+                if old is not None and old.read(len(chunk)) == chunk:
+                    matched += len(chunk)
+                    continue
+                f = open(tmp_fpath, 'wb')
+                if matched:
+                    _copy_prefix(old, f, matched)
+            f.write(chunk)
+        if f is None:
+            if old is not None and old.read(1) == b'':
+                return False
+            f = open(tmp_fpath, 'wb')
+            if matched:
+                _copy_prefix(old, f, matched)
+        f.close()
+        os.replace(tmp_fpath, fpath)
+        return True
+    except BaseException:
+        if f is not None:
+            f.close()
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+
+# where writing raw name to fpath ends up: fpath itself, or name.txt if
+# fpath is a directory ending in a separator
+def raw_target(fpath, name, verbosity = 0):
     fname = os.path.basename(fpath)
     if fname == '':
         fname = name + '.txt'
@@ -172,15 +480,70 @@ def writeraw(fpath, tup, verbosity = 0):
         if fname_cleaned != name:
             print('WARNING: requested filename {:s} does not match raw name {:s}'
                   .format(repr(fname), repr(name)))
+    return fpath
+
+# write valid readraw tuple to file
+def writeraw(fpath, tup, verbosity = 0, chunk_size = 1 << 16, skip_unchanged = False):
+    name, objc, objt, content = tup
+    fpath = raw_target(fpath, name, verbosity=verbosity)
+    fname = os.path.basename(fpath)
 
-    # Since encoding creates the entire buffer in memory, this could have 2x overhead.
-    # Probably doesn't matter.
-    with open(fpath, 'wb') as f:
-        f.write(encoderaw(tup))
+    written = atomic_write(fpath, iterencoderaw(tup, chunk_size=chunk_size),
+                           skip_unchanged=skip_unchanged)
 
     if verbosity >= 1:
-        print('wrote {:s}, {:s}'
-              .format(fname, '[OBJECT:'+objt+']'))
+        print('{:s} {:s}, {:s}'
+              .format('wrote' if written else 'unchanged', fname, '[OBJECT:'+objt+']'))
+
+    return written
+
+# encode content on its own, such as one object's contexts, for patchraw;
+# newline should match the file being patched
+def encodecontent(content, newline = b'\r\n'):
+    return crlf(''.join(c + t for c, t, _, _ in content).encode(df_raw_encoding), newline)
+
+# Copy the raw file at src_fpath with some byte ranges replaced. patches
+# is a sorted list of non-overlapping (start, end, replacement bytes).
+# buf, if given, is the source already mapped (see mapraw), used as is.
+def iterpatchraw(src_fpath, patches, chunk_size = 1 << 16, buf = None):
+    if buf is not None:
+        yield from _iterpatch(buf, patches, chunk_size)
+        return
+    with open(src_fpath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _iterpatch(mm, patches, chunk_size)
+
+def _iterpatch(mm, patches, chunk_size):
+    pos = 0
+    for start, end, data in patches:
+        for i in range(pos, start, chunk_size):
+            yield mm[i:min(i + chunk_size, start)]
+        yield data
+        pos = end
+    for i in range(pos, len(mm), chunk_size):
+        yield mm[i:i + chunk_size]
+
+# Like writeraw, for a raw file that was read from src_fpath and only
+# changed in the patched ranges. Rewriting the source file itself with
+# no patches is skipped outright.
+def patchraw(fpath, src_fpath, name, objt, patches, verbosity = 0, chunk_size = 1 << 16,
+             skip_unchanged = False, buf = None):
+    fpath = raw_target(fpath, name, verbosity=verbosity)
+    fname = os.path.basename(fpath)
+
+    if not patches and os.path.exists(fpath) and os.path.samefile(fpath, src_fpath):
+        written = False
+    else:
+        written = atomic_write(fpath, iterpatchraw(src_fpath, patches, chunk_size=chunk_size,
+                                                   buf=buf),
+                               skip_unchanged=skip_unchanged)
+
+    if verbosity >= 1:
+        print('{:s} {:s}, {:s}, {:d} objects patched'
+              .format('wrote' if written else 'unchanged', fname, '[OBJECT:'+objt+']',
+                      len(patches)))
+
+    return written
 
 
 if __name__ == '__main__':
@@ -199,6 +562,12 @@ if __name__ == '__main__':
     if len(sys.argv) > 2:
         print('parse / unparse pass!')
 
+    # test alternative engines against the regex engine
+    for engine in engines:
+        assert fparse(fpath, engine=engine) == rawtup
+    if len(sys.argv) > 2:
+        print('engines agree!')
+
     readtup = readraw(fpath, verbosity=1)
     name, objc, objt, content = readtup
     if len(sys.argv) > 3:
@@ -209,5 +578,7 @@ if __name__ == '__main__':
     rawname, objdata, _ = rawtup
     if valid(rawname, objdata):
         assert encoderaw(readtup).decode(df_raw_encoding).strip() == bits_cleaned
+        for chunk_size in (1, 7, 1 << 16):
+            assert b''.join(iterencoderaw(readtup, chunk_size=chunk_size)) == encoderaw(readtup)
         if len(sys.argv) > 2:
             print('readraw / encoderaw pass!')
@@ -0,0 +1,215 @@
+# query language for raw objects
+#
+#   [select FIELD, ... where] PREDICATE and PREDICATE and ...
+#
+# where each predicate may be prefixed with 'not', and is one of
+#
+#   TOKEN                    the object has a TOKEN token
+#   TOKEN[k] OP VALUE        some TOKEN token's field k compares true;
+#                            field 0 is the token name, as in Rindex.column
+#   arg = VALUE              some token has VALUE as an argument
+#   subtype = NAME           the object's subtype, ident or namespace name
+#   ident = NAME
+#   namespace = NAME
+#
+# OP is one of = != < <= > >=. Values that look like numbers compare
+# numerically, everything else as strings; values may be quoted. FIELDs
+# are ident, subtype, namespace, or TOKEN[k], the field of the first TOKEN
+# token (None if there is none).
+#
+#   select ident, BODY_SIZE[3] where subtype = CREATURE and BODY_SIZE[3] > 100000 and not FLIER
+
+import re
+import operator
+
+df_query_ops = {
+    '=' : operator.eq,
+    '!=' : operator.ne,
+    '<' : operator.lt,
+    '<=' : operator.le,
+    '>' : operator.gt,
+    '>=' : operator.ge,
+}
+
+df_query_attrs = ('subtype', 'ident', 'namespace')
+
+query_token_re = re.compile(r'''\s*(?:(?P<str>'[^']*'|"[^"]*")|(?P<op>!=|<=|>=|=|<|>)'''
+                            r'''|(?P<punct>[\[\],])|(?P<name>[^\s\[\],=!<>'"]+))''')
+
+def _number(v):
+    try:
+        return float(v)
+    except ValueError:
+        return None
+
+class Rpred(object):
+    __slots__ = ('kind', 'negated', 'tokname', 'pos', 'op', 'value', 'num')
+
+    # kind is 'token', 'field', 'arg' or one of df_query_attrs
+    def __init__(self, kind, tokname = None, pos = None, op = None, value = None):
+        self.kind = kind
+        self.negated = False
+        self.tokname = tokname
+        self.pos = pos
+        self.op = op
+        self.value = value
+        self.num = None if value is None else _number(value)
+
+    def _compare(self, v):
+        if self.num is not None:
+            x = _number(v)
+            if x is None:
+                return False
+            return df_query_ops[self.op](x, self.num)
+        return df_query_ops[self.op](v, self.value)
+
+    def match(self, robj):
+        kind = self.kind
+        if kind == 'token':
+            return self.tokname in robj
+        elif kind == 'field':
+            if self.tokname not in robj:
+                return False
+            pos = self.pos
+            for tags in robj[self.tokname]:
+                if pos < len(tags) and self._compare(tags[pos]):
+                    return True
+            return False
+        elif kind == 'arg':
+            return any(self.value in tags[1:] for tags in robj)
+        elif kind == 'namespace':
+            return self._compare(robj.namespace.name)
+        else:
+            return self._compare(getattr(robj, kind))
+
+    def test(self, robj):
+        return self.match(robj) != self.negated
+
+    def __repr__(self):
+        if self.kind == 'token':
+            s = self.tokname
+        elif self.kind == 'field':
+            s = '{:s}[{:d}] {:s} {:s}'.format(self.tokname, self.pos, self.op, repr(self.value))
+        else:
+            s = '{:s} {:s} {:s}'.format(self.kind, self.op, repr(self.value))
+        return 'not ' + s if self.negated else s
+
+class Rquery(object):
+    def __init__(self, preds, fields = None):
+        self.preds = preds
+        # None, or [(attr,) or (tokname, pos)]
+        self.fields = fields
+
+    def project(self, robj):
+        row = []
+        for field in self.fields:
+            if len(field) == 1:
+                attr = field[0]
+                row.append(robj.namespace.name if attr == 'namespace' else getattr(robj, attr))
+            else:
+                tokname, pos = field
+                v = None
+                if tokname in robj:
+                    tags = robj[tokname][0]
+                    if pos < len(tags):
+                        v = tags[pos]
+                row.append(v)
+        return tuple(row)
+
+class _Lexer(object):
+    def __init__(self, text):
+        self.text = text
+        self.toks = []
+        i = 0
+        while i < len(text):
+            m = query_token_re.match(text, i)
+            if m is None or m.end() == i:
+                if text[i:].strip() == '':
+                    break
+                raise ValueError('bad query {:s} at {:d}'.format(repr(text), i))
+            kind = m.lastgroup
+            v = m.group(kind)
+            if kind == 'str':
+                v = v[1:-1]
+            self.toks.append((kind, v, m.start(kind)))
+            i = m.end()
+        self.i = 0
+
+    def peek(self):
+        if self.i < len(self.toks):
+            return self.toks[self.i]
+        return None, None, len(self.text)
+
+    def next(self, kind = None, value = None):
+        k, v, at = self.peek()
+        if (kind is not None and k != kind) or (value is not None and v != value):
+            want = value if value is not None else kind
+            raise ValueError('bad query {:s} at {:d}: expected {:s}, got {:s}'
+                             .format(repr(self.text), at, want, repr(v)))
+        self.i += 1
+        return v
+
+    def accept(self, kind, value = None):
+        k, v, _ = self.peek()
+        if k == kind and (value is None or v == value):
+            self.i += 1
+            return True
+        return False
+
+    def value(self):
+        k, v, _ = self.peek()
+        if k in ('str', 'name'):
+            self.i += 1
+            return v
+        return self.next('name')
+
+    def index(self):
+        self.next('punct', '[')
+        v = self.next('name')
+        self.next('punct', ']')
+        try:
+            return int(v)
+        except ValueError:
+            raise ValueError('bad query {:s}: field index {:s} is not an int'
+                             .format(repr(self.text), repr(v)))
+
+def _parse_field(lex):
+    name = lex.next('name')
+    if name in df_query_attrs:
+        return (name,)
+    return (name, lex.index())
+
+def _parse_pred(lex):
+    if lex.accept('name', 'not'):
+        pred = _parse_pred(lex)
+        pred.negated = not pred.negated
+        return pred
+    name = lex.next('name')
+    if name in df_query_attrs or name == 'arg':
+        op = lex.next('op')
+        if name == 'arg' and op != '=':
+            raise ValueError('bad query {:s}: arg only supports ='.format(repr(lex.text)))
+        return Rpred(name, op=op, value=lex.value())
+    k, v, _ = lex.peek()
+    if k == 'punct' and v == '[':
+        pos = lex.index()
+        op = lex.next('op')
+        return Rpred('field', tokname=name, pos=pos, op=op, value=lex.value())
+    return Rpred('token', tokname=name)
+
+def parse_query(text):
+    lex = _Lexer(text)
+    fields = None
+    if lex.accept('name', 'select'):
+        fields = [_parse_field(lex)]
+        while lex.accept('punct', ','):
+            fields.append(_parse_field(lex))
+        lex.next('name', 'where')
+    preds = [_parse_pred(lex)]
+    while lex.accept('name', 'and'):
+        preds.append(_parse_pred(lex))
+    k, v, at = lex.peek()
+    if k is not None:
+        raise ValueError('bad query {:s} at {:d}: unexpected {:s}'
+                         .format(repr(text), at, repr(v)))
+    return Rquery(preds, fields)
@@ -0,0 +1,203 @@
+# dwarf fortress raw validation server
+
+import os
+import sys
+import time
+import json
+import asyncio
+import concurrent.futures
+
+import rawid
+import rawdiag
+
+# Requests and responses are JSON, one object per line, over stdin / stdout
+# or a unix socket. A request names pack directories, and optionally the
+# base directories (usually vanilla) each pack is layered over:
+#
+#   {"id": 1, "packs": ["mods/a/objects", "mods/b/objects"], "base": ["raw/objects"]}
+#
+# Every pack is answered as soon as it has been validated, in whatever
+# order they finish, followed by one line that closes the request:
+#
+#   {"id": 1, "pack": "mods/b/objects", "ok": true, "problems": [], ...}
+#   {"id": 1, "pack": "mods/a/objects", "ok": false, "problems": [...], ...}
+#   {"id": 1, "done": true, "packs": 2, "failed": 1}
+#
+# Bases are parsed once per worker process and kept warm; later requests
+# only refresh them, which re-reads just the files that changed on disk
+# and prunes each base's own string pool once old versions pile up.
+
+# base directory -> Rindex, per process
+_bases = {}
+
+def _base(rawroot):
+    if rawroot in _bases:
+        ridx = _bases[rawroot]
+        ridx.refresh()
+    else:
+        ridx = rawid.Rindex(rawroot=rawroot, verbosity=-1, strict=False, diag=True)
+        _bases[rawroot] = ridx
+    return ridx
+
+def _warm(bases):
+    for rawroot in bases:
+        try:
+            _base(rawroot)
+        except Exception:
+            # reported again, per pack, when a request actually uses it
+            pass
+
+def _problem(diag, record):
+    code, fpath, offset, ident, _ = record
+    return {
+        'code' : code,
+        'severity' : rawdiag.df_diag_codes[code][0],
+        'message' : diag.message(record),
+        'file' : fpath,
+        'offset' : offset,
+        'ident' : ident,
+    }
+
+# Validate one pack directory layered over bases. Every problem is
+# collected rather than stopping at the first, and references from the
+# pack that resolve neither in it nor in a base are reported as dangling.
+def validate(pack, bases = ()):
+    start = time.perf_counter()
+    result = {'pack' : pack}
+    try:
+        layers = [_base(rawroot) for rawroot in bases]
+        ridx = rawid.Rindex(rawroot=pack, verbosity=-1, strict=True, diag=True)
+        overlay = rawid.Roverlay(layers + [ridx], verbosity=-1, diag=True)
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = '{:s}: {:s}'.format(type(e).__name__, str(e))
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    own = {id(rns) for rns in ridx.namespaces}
+    problems = ([_problem(ridx.diag, r) for r in ridx.diag]
+                + [_problem(overlay.diag, r) for r in overlay.diag])
+    dangling = [{'subtype' : robj.subtype, 'ident' : robj.ident, 'token' : i, 'arg' : j,
+                 'target' : [subtype, ident], 'file' : robj.namespace.fpath}
+                for robj, i, j, subtype, ident in overlay.dangling()
+                if id(robj.namespace) in own]
+    summary = ridx.diag.summary()
+    for code, count in overlay.diag.summary().items():
+        summary[code] = summary.get(code, 0) + count
+
+    result['ok'] = not any(p['severity'] == 'INVALID' for p in problems)
+    result['namespaces'] = len(ridx.namespaces)
+    result['objects'] = len(ridx.objects)
+    result['shadowed'] = sum(1 for robj in overlay.shadowed if id(robj.namespace) not in own)
+    result['summary'] = summary
+    result['problems'] = problems
+    result['dangling'] = dangling
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+class Rserver(object):
+    # With workers > 1 packs are validated in that many processes, each
+    # with its own warm bases. Otherwise they are validated one at a time
+    # on a single background thread, so the event loop stays responsive.
+    def __init__(self, workers = None, bases = ()):
+        self.workers = workers
+        # absolute, as handle() looks them up
+        self.bases = [os.path.abspath(rawroot) for rawroot in bases]
+        if workers is not None and workers > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_warm, initargs=(self.bases,))
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, initializer=_warm, initargs=(self.bases,))
+
+    def close(self):
+        self.pool.shutdown()
+
+    async def handle(self, line, send):
+        try:
+            request = json.loads(line)
+            rid = request.get('id')
+            packs = request['packs']
+            bases = request.get('base', self.bases)
+            if isinstance(packs, str) or isinstance(bases, str):
+                raise ValueError('packs and base must be lists of directories')
+        except Exception as e:
+            await send({'error' : 'bad request: {:s}'.format(str(e))})
+            return
+
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self.pool, validate, os.path.abspath(pack),
+                                        [os.path.abspath(rawroot) for rawroot in bases])
+                   for pack in packs]
+        failed = 0
+        for future in asyncio.as_completed(futures):
+            result = await future
+            if not result['ok']:
+                failed += 1
+            result['id'] = rid
+            await send(result)
+        await send({'id' : rid, 'done' : True, 'packs' : len(packs), 'failed' : failed})
+
+    # requests on one stream are handled concurrently, answers interleave
+    async def serve(self, reader, write, drain = None):
+        async def send(obj):
+            write((json.dumps(obj) + '\n').encode())
+            if drain is not None:
+                await drain()
+
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.ensure_future(self.handle(line, send))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        def write(data):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+        await self.serve(reader, write)
+
+    async def serve_unix(self, path):
+        async def client(reader, writer):
+            try:
+                await self.serve(reader, writer.write, writer.drain)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_unix_server(client, path=path)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='validate raw packs, one JSON request per line')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='listen on a unix socket instead of stdin / stdout')
+    parser.add_argument('--workers', type=int, help='validate packs in this many processes')
+    parser.add_argument('--base', action='append', default=[], metavar='RAWDIR',
+                        help='base raws to keep warm, used when a request names none')
+    args = parser.parse_args()
+
+    server = Rserver(workers=args.workers, bases=args.base)
+    try:
+        if args.socket is None:
+            asyncio.run(server.serve_stdio())
+        else:
+            asyncio.run(server.serve_unix(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,122 @@
+import os
+import time
+import io
+import contextlib
+
+# Build phases, in the order they happen for one file. The regex engine
+# decodes each token as it scans, so for it 'decode' stays near zero and
+# the decoding cost shows up under 'scan'.
+df_phases = ('read', 'decode', 'scan', 'split', 'index', 'creature')
+
+class Rstats(object):
+    def __init__(self, profile = False, memory = False):
+        self.profile = profile
+        self.memory = memory
+        # phase -> [seconds, calls]
+        self.phases = {}
+        # file path -> {'bytes', 'tokens', 'objects', 'seconds'}
+        self.files = {}
+        self.profile_stats = None
+        self.peak_memory = None
+
+    def add(self, phase, seconds, fpath = None):
+        if phase in self.phases:
+            t = self.phases[phase]
+            t[0] += seconds
+            t[1] += 1
+        else:
+            self.phases[phase] = [seconds, 1]
+        if fpath is not None:
+            self.count(fpath, seconds=seconds)
+
+    def count(self, fpath, **counters):
+        if fpath in self.files:
+            record = self.files[fpath]
+        else:
+            record = self.files[fpath] = {'bytes' : 0, 'tokens' : 0, 'objects' : 0, 'seconds' : 0.0}
+        for k, v in counters.items():
+            record[k] += v
+
+    @contextlib.contextmanager
+    def timer(self, phase, fpath = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, fpath=fpath)
+
+    def merge(self, other):
+        for phase, (seconds, calls) in other.phases.items():
+            if phase in self.phases:
+                t = self.phases[phase]
+                t[0] += seconds
+                t[1] += calls
+            else:
+                self.phases[phase] = [seconds, calls]
+        for fpath, record in other.files.items():
+            self.count(fpath, **record)
+
+    # Wraps a whole build. cProfile and tracemalloc both slow the build
+    # down noticeably, so they only run when asked for.
+    @contextlib.contextmanager
+    def capture(self):
+        prof = None
+        if self.profile:
+            import cProfile
+            prof = cProfile.Profile()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        try:
+            if prof is not None:
+                prof.enable()
+            with self.timer('total'):
+                yield
+        finally:
+            if prof is not None:
+                prof.disable()
+                import pstats
+                self.profile_stats = pstats.Stats(prof, stream=io.StringIO())
+            if self.memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.peak_memory = peak
+
+    # profiler output holds a stream, and is only useful in this process anyway
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['profile_stats'] = None
+        return state
+
+    def totals(self):
+        return {k : sum(record[k] for record in self.files.values())
+                for k in ('bytes', 'tokens', 'objects')}
+
+    def slowest(self, n = 10):
+        return sorted(self.files.items(), key=lambda x: x[1]['seconds'], reverse=True)[:n]
+
+    def report(self, n = 10, profile_lines = 20):
+        lines = []
+        totals = self.totals()
+        lines.append('{:d} files, {:d} bytes, {:d} tokens, {:d} objects'
+                     .format(len(self.files), totals['bytes'], totals['tokens'], totals['objects']))
+        phases = [p for p in df_phases if p in self.phases]
+        phases += sorted(p for p in self.phases if p not in df_phases)
+        for phase in phases:
+            seconds, calls = self.phases[phase]
+            lines.append('  {:10s} {:10.4f}s {:8d} calls'.format(phase, seconds, calls))
+        if self.peak_memory is not None:
+            lines.append('  peak memory {:d} bytes'.format(self.peak_memory))
+        if self.files:
+            lines.append('slowest files:')
+            for fpath, record in self.slowest(n):
+                lines.append('  {:10.4f}s {:10d} bytes {:8d} tokens {:6d} objects  {:s}'
+                             .format(record['seconds'], record['bytes'], record['tokens'],
+                                     record['objects'], os.path.basename(fpath)))
+        if self.profile_stats is not None:
+            stream = self.profile_stats.stream
+            stream.seek(0)
+            stream.truncate()
+            self.profile_stats.sort_stats('cumulative').print_stats(profile_lines)
+            lines.append(stream.getvalue().rstrip())
+        return '\n'.join(lines)